@@ -0,0 +1,215 @@
+# benchmark.py - замеры горячих путей бота на синтетических счетах
+#
+#   python benchmark.py --sizes 100,1000,10000 --repeat 5 --output bench_results.json
+#   python benchmark.py --compare bench_results.json   # сравнить с прошлым прогоном
+#
+# Нужен одноразовый Postgres: BENCH_DATABASE_URL, либо установленный pgserver
+# (pip install pgserver) — тогда временный сервер поднимается сам.
+
+import os
+import io
+import sys
+import json
+import time
+import random
+import asyncio
+import argparse
+import platform
+import tempfile
+import tracemalloc
+import statistics
+from datetime import date, timedelta
+import openpyxl
+
+BENCH_USER_ID = -1
+REGRESSION_THRESHOLD = 0.2  # на сколько (доля) можно стать медленнее без предупреждения
+
+ROUTES = ["Москва - Тула", "Москва - Рязань", "Тверь - Москва", "Калуга - Обнинск", "Москва - Владимир", "Подольск - Серпухов"]
+SURNAMES = ["Иванов", "Петров", "Сидоров", "Кузнецов", "Смирнов", "Попов", "Волков", "Соколов", "Лебедев", "Козлов"]
+AMOUNTS = [20000, 36000, 140000, 24000, 155000, 304000, 195000, 40000, 185000, 35000, 260000]
+
+def generate_invoice(rows: int, seed: int = 0, cars: int = 50) -> bytes:
+    """Собирает xlsx в формате счета: шапка, таблица 'Товары (работы, услуги)'/'Сумма' и итоговые строки."""
+    rng = random.Random(seed)
+    plates = [f"{n:03d}" for n in rng.sample(range(100, 1000), cars)]
+    start = date(2024, 1, 1)
+    wb = openpyxl.Workbook()
+    ws = wb.active
+    ws['A1'] = f"Счет на оплату № {seed} от {start:%d.%m.%Y}"
+    ws['A3'] = "Поставщик: ООО \"Перевозчик\""
+    ws['A4'] = "Покупатель: ООО \"Заказчик\""
+    header_row = 6
+    for col, title in enumerate(["№", "Товары (работы, услуги)", "Кол-во", "Ед.", "Цена", "Сумма"], 1):
+        ws.cell(header_row, col, title)
+    for i in range(rows):
+        trip_date = start + timedelta(days=rng.randrange(365))
+        surname = rng.choice(SURNAMES)
+        description = (f"{rng.choice(ROUTES)}, перевозка грузов от {trip_date:%d.%m.%y}, "
+                       f"а/м {rng.choice(plates)}, {surname} {rng.choice('АБВГДЕ')}.{rng.choice('АБВГДЕ')}.")
+        amount = rng.choice(AMOUNTS)
+        row = header_row + 1 + i
+        ws.cell(row, 1, i + 1)
+        ws.cell(row, 2, description)
+        ws.cell(row, 3, 1)
+        ws.cell(row, 4, "усл.")
+        ws.cell(row, 5, amount)
+        ws.cell(row, 6, f"{amount:,.2f}".replace(",", " ").replace(".", ",") if i % 3 == 0 else amount)
+    ws.cell(header_row + rows + 1, 5, "Итого:")
+    ws.cell(header_row + rows + 2, 5, "Всего к оплате:")
+    output = io.BytesIO()
+    wb.save(output)
+    return output.getvalue()
+
+def start_local_postgres():
+    """Поднимает временный Postgres через pgserver, если BENCH_DATABASE_URL не задан."""
+    url = os.getenv("BENCH_DATABASE_URL")
+    if url:
+        return url, None
+    try:
+        import pgserver
+    except ImportError:
+        sys.exit("Задайте BENCH_DATABASE_URL или установите pgserver (pip install pgserver).")
+    server = pgserver.get_server(tempfile.mkdtemp(prefix="bench_pg_"), cleanup_mode="delete")
+    return server.get_uri(), server
+
+class FakeBot:
+    """Заглушка Telegram-бота: вычитывает документ целиком, как это сделал бы клиент при отправке."""
+    async def send_document(self, chat_id, document, filename=None, caption=None, **kwargs):
+        document.read()
+
+class FakeContext:
+    bot = FakeBot()
+
+def summarize(timings: list, rows: int, peak_bytes: int) -> dict:
+    timings = sorted(timings)
+    def percentile(p):
+        return timings[min(len(timings) - 1, round(p / 100 * (len(timings) - 1)))]
+    return {
+        'rows': rows,
+        'runs': len(timings),
+        'mean_s': statistics.fmean(timings),
+        'p50_s': percentile(50),
+        'p95_s': percentile(95),
+        'p99_s': percentile(99),
+        'rows_per_s': rows / statistics.median(timings) if rows else None,
+        'peak_mem_mb': peak_bytes / 1024 / 1024,
+    }
+
+async def measure(func, repeat: int) -> tuple:
+    """Прогоняет корутину-фабрику repeat раз для времени и еще раз под tracemalloc для пиковой памяти."""
+    timings = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        await func()
+        timings.append(time.perf_counter() - started)
+    tracemalloc.start()
+    await func()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return timings, peak
+
+async def run_benchmarks(sizes: list, repeat: int) -> dict:
+    import db
+    import bot
+    from parser import process_excel_file
+
+    if not await db.init_db():
+        sys.exit("Не удалось подключиться к базе.")
+    async with db.pool.acquire() as conn:
+        await conn.execute("INSERT INTO users (user_id, first_name) VALUES ($1, 'benchmark') ON CONFLICT DO NOTHING", BENCH_USER_ID)
+
+    results = {}
+    for size in sizes:
+        content = generate_invoice(size, seed=size)
+        name = f"bench_{size}.xlsx"
+        df = process_excel_file(content, name)
+        case = {}
+
+        async def parse():
+            process_excel_file(content, name)
+        timings, peak = await measure(parse, repeat)
+        case['process_excel_file'] = summarize(timings, size, peak)
+
+        async def insert():
+            await db.clear_user_data(BENCH_USER_ID)
+            await db.add_trips_from_df(BENCH_USER_ID, df)
+        timings, peak = await measure(insert, repeat)
+        case['add_trips_from_df'] = summarize(timings, len(df), peak)
+
+        async def fetch():
+            db.invalidate_user(BENCH_USER_ID)  # меряем запрос, а не попадание в кэш
+            await db.get_all_trips_as_df(BENCH_USER_ID)
+        timings, peak = await measure(fetch, repeat)
+        case['get_all_trips_as_df'] = summarize(timings, len(df), peak)
+
+        full_df = await db.get_all_trips_as_df(BENCH_USER_ID)
+        plate = full_df['Гос_номер'].value_counts().index[0]
+        car_df = full_df[full_df['Гос_номер'] == plate]
+        async def car_report():
+            await bot.create_car_report_excel(car_df, plate)
+        timings, peak = await measure(car_report, repeat)
+        case['create_car_report_excel'] = summarize(timings, len(car_df), peak)
+
+        async def full_report():
+            await bot.send_excel_report(BENCH_USER_ID, 0, FakeContext(), "bench.xlsx")
+        timings, peak = await measure(full_report, repeat)
+        case['send_excel_report'] = summarize(timings, len(df), peak)
+
+        results[str(size)] = case
+        print(f"size={size}: " + ", ".join(f"{k} p50={v['p50_s'] * 1000:.1f}ms" for k, v in case.items()))
+
+    await db.clear_user_data(BENCH_USER_ID)
+    await db.pool.close()
+    return results
+
+def compare(current: dict, baseline: dict) -> list:
+    """Возвращает строки с регрессиями p50 больше REGRESSION_THRESHOLD."""
+    regressions = []
+    for size, case in current.items():
+        for name, stats in case.items():
+            old = baseline.get(size, {}).get(name)
+            if not old: continue
+            change = stats['p50_s'] / old['p50_s'] - 1 if old['p50_s'] else 0
+            line = f"size={size} {name}: p50 {old['p50_s'] * 1000:.1f}ms -> {stats['p50_s'] * 1000:.1f}ms ({change:+.0%})"
+            print(line)
+            if change > REGRESSION_THRESHOLD:
+                regressions.append(line)
+    return regressions
+
+def main():
+    arg_parser = argparse.ArgumentParser(description="Бенчмарк горячих путей бота.")
+    arg_parser.add_argument("--sizes", default="100,1000,5000", help="размеры счетов в строках через запятую")
+    arg_parser.add_argument("--repeat", type=int, default=5, help="сколько раз мерить каждый шаг")
+    arg_parser.add_argument("--output", default="bench_results.json", help="куда записать результаты")
+    arg_parser.add_argument("--compare", help="файл с результатами прошлого прогона для сравнения")
+    args = arg_parser.parse_args()
+
+    url, server = start_local_postgres()
+    os.environ["DATABASE_URL"] = url
+    try:
+        results = asyncio.run(run_benchmarks([int(s) for s in args.sizes.split(",")], args.repeat))
+    finally:
+        if server is not None:
+            server.cleanup()
+
+    report = {
+        'created_at': time.strftime("%Y-%m-%dT%H:%M:%S"),
+        'python': platform.python_version(),
+        'machine': platform.machine(),
+        'repeat': args.repeat,
+        'results': results,
+    }
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"Результаты записаны в {args.output}")
+
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)['results']
+        regressions = compare(results, baseline)
+        if regressions:
+            print("Регрессии:\n" + "\n".join(regressions))
+            sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -1,10 +1,12 @@
 # bot.py (ВЕРСИЯ 7.1 - ПРОФЕССИОНАЛЬНЫЕ ОТЧЕТЫ, ПОЛНЫЙ КОД)
 
 import os
+import re
 import logging
 import pandas as pd
 import io
 import asyncio
+import hashlib
 from datetime import datetime
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup
 from telegram.ext import (
@@ -18,10 +20,15 @@ from telegram.ext import (
     ConversationHandler
 )
 from telegram.error import BadRequest
-import threading
-from http.server import BaseHTTPRequestHandler, HTTPServer
-from parser import process_excel_file
 import db
+import dispatch
+import export
+import health
+import ingest
+import metrics
+import outbound
+import persistence
+import report_cache
 
 # --- Настройка ---
 logging.basicConfig(format='%(asctime)s - %(name)s - %(levelname)s - %(message)s', level=logging.INFO)
@@ -49,6 +56,7 @@ def get_main_menu_keyboard():
         [InlineKeyboardButton("👤 Статистика по фамилии", callback_data='main_ask_driver_stats')],
         [InlineKeyboardButton("📥 Экспорт в Excel", callback_data='main_export_menu')],
         [InlineKeyboardButton("🏆 Топ-5", callback_data='main_top')],
+        [InlineKeyboardButton("📅 Выбрать период", callback_data='main_period')],
         [InlineKeyboardButton("🗑️ Очистить данные", callback_data='main_clear')],
     ])
 def get_export_menu_keyboard():
@@ -56,6 +64,7 @@ def get_export_menu_keyboard():
         [InlineKeyboardButton("📄 Полный отчет", callback_data='export_full')],
         [InlineKeyboardButton("🚗 По гос. номеру (кастомный)", callback_data='export_ask_car')],
         [InlineKeyboardButton("👤 По фамилии", callback_data='export_ask_driver')],
+        [InlineKeyboardButton("🚛 Весь автопарк (лист на машину)", callback_data='export_fleet')],
         [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_main_menu')],
     ])
 post_upload_keyboard = InlineKeyboardMarkup([
@@ -63,68 +72,105 @@ post_upload_keyboard = InlineKeyboardMarkup([
     [InlineKeyboardButton("👤 Отчет по водителям", callback_data='summary_driver')],
     [InlineKeyboardButton("⬅️ В главное меню", callback_data='back_to_main_menu')]
 ])
+PERIOD_MONTHS_SHOWN = 24
+def get_period_keyboard(months: list):
+    buttons = [InlineKeyboardButton(f"{RUSSIAN_MONTHS[month.month]} {month.year} ({trips})", callback_data=f'period_{month:%Y-%m}')
+               for month, trips, _ in months[:PERIOD_MONTHS_SHOWN]]
+    rows = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+    return InlineKeyboardMarkup([[InlineKeyboardButton("🗓️ За все время", callback_data='period_all')], *rows,
+                                 [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_main_menu')]])
 cancel_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("❌ Отмена", callback_data='cancel_conversation')]])
 back_to_main_menu_keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_main_menu')]])
 
+def get_period(context: ContextTypes.DEFAULT_TYPE) -> tuple:
+    """Выбранный пользователем месяц: (date_from, date_to, подпись) или (None, None, None) - все время."""
+    period = context.user_data.get('period')
+    if not period: return None, None, None
+    month = datetime.strptime(period, '%Y-%m').date()
+    date_from, date_to = db.month_range(month)
+    return date_from, date_to, f"{RUSSIAN_MONTHS[month.month]} {month.year}"
+
 # --- ИНИЦИАЛИЗАЦИЯ БД ---
 async def post_init(application: Application):
+    await health.start_server()
     if not await db.init_db():
         logging.critical("CRITICAL: Could not initialize database.")
+    ingest.start_workers()
+    db.start_user_flusher()
+    db.start_listener()
+
+async def post_shutdown(application: Application):
+    await ingest.stop_workers()
+    await db.stop_user_flusher()
+    await db.stop_listener()
+    await health.stop_server()
 
 # --- НОВАЯ, УЛУЧШЕННАЯ ФУНКЦИЯ СОЗДАНИЯ ОТЧЕТА ---
-async def create_car_report_excel(df: pd.DataFrame, car_plate: str) -> io.BytesIO:
-    output = io.BytesIO()
-    
-    report_df = df.copy()
-    report_df['ЗП Водителя'] = report_df['Стоимость'].map(EARNINGS_MAP)
-    final_df = report_df[['Дата', 'Маршрут', 'Стоимость', 'ЗП Водителя']].copy()
-    
-    total_cost = final_df['Стоимость'].sum()
-    total_driver_earnings = final_df['ЗП Водителя'].sum()
-    tax = total_cost * 0.11
-    profit = total_cost - total_driver_earnings - tax
+def get_report_formats(workbook) -> dict:
+    return {
+        'title': workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter'}),
+        'header': workbook.add_format({'bold': True, 'border': 1, 'bg_color': '#DDEBF7', 'align': 'center', 'valign': 'vcenter'}),
+        'cell_border': workbook.add_format({'border': 1}),
+        'currency_border': workbook.add_format({'border': 1, 'num_format': '#,##0'}),
+        'date_border': workbook.add_format({'border': 1, 'num_format': 'dd.mm.yy'}),
+        'summary_label': workbook.add_format({'bold': True, 'align': 'right'}),
+        'summary_value': workbook.add_format({'bold': True, 'num_format': '#,##0'}),
+    }
 
-    month_name = ""
-    try:
-        first_date_str = final_df['Дата'].dropna().iloc[0]
-        month_num = datetime.strptime(first_date_str, '%d.%m.%y').month
-        month_name = RUSSIAN_MONTHS.get(month_num, '')
-    except (IndexError, ValueError): pass
+INVALID_SHEET_CHARS = re.compile(r'[\[\]:*?/\\]')
+def unique_sheet_name(name: str, used: set) -> str:
+    """Имя листа Excel: без запрещенных символов, не длиннее 31 символа и не повторяющееся в книге."""
+    base = INVALID_SHEET_CHARS.sub('_', name)[:31] or "Лист"
+    candidate, n = base, 1
+    while candidate.lower() in used:
+        n += 1
+        suffix = f" ({n})"
+        candidate = base[:31 - len(suffix)] + suffix
+    used.add(candidate.lower())
+    return candidate
 
-    sheet_name = f"{car_plate} {month_name}".strip()
-    sheet_title = f"Отчет по машине {car_plate} за {month_name}"
+def column_values(series: pd.Series) -> list:
+    """Значения колонки для write_column: пропуски - пустые ячейки (с рамкой), а не NaN/NaT."""
+    return series.astype(object).where(series.notna(), '').tolist()
 
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        workbook = writer.book
-        worksheet = workbook.add_worksheet(sheet_name)
-        writer.sheets[sheet_name] = worksheet
+def write_car_sheet(workbook, formats: dict, df: pd.DataFrame, car_plate: str, month_name: str = None, used_names: set = None) -> dict:
+    """Пишет в книгу лист отчета по одной машине. Возвращает итоги: поездки, стоимость, ЗП, налог, прибыль."""
+    with metrics.phase('pandas'):
+        report_df = df.copy()
+        report_df['ЗП Водителя'] = report_df['Стоимость'].map(EARNINGS_MAP)
+        final_df = report_df[['Дата', 'Маршрут', 'Стоимость', 'ЗП Водителя']].copy()
 
-        # --- Создаем форматы ---
-        title_format = workbook.add_format({'bold': True, 'font_size': 14, 'align': 'center', 'valign': 'vcenter'})
-        header_format = workbook.add_format({'bold': True, 'border': 1, 'bg_color': '#DDEBF7', 'align': 'center', 'valign': 'vcenter'})
-        cell_border_format = workbook.add_format({'border': 1})
-        currency_border_format = workbook.add_format({'border': 1, 'num_format': '#,##0'})
-        date_border_format = workbook.add_format({'border': 1, 'num_format': 'dd.mm.yy'})
-        
-        summary_label_format = workbook.add_format({'bold': True, 'align': 'right'})
-        summary_value_format = workbook.add_format({'bold': True, 'num_format': '#,##0'})
+        # Суммы в float32 теряют рубли уже на десятках миллионов, итоги считаем в float64
+        total_cost = final_df['Стоимость'].astype('float64').sum()
+        total_driver_earnings = final_df['ЗП Водителя'].sum()
+        tax = total_cost * 0.11
+        profit = total_cost - total_driver_earnings - tax
+
+        if month_name is None:
+            # Период не выбран - берем месяц по первой поездке
+            month_name = ""
+            dates = final_df['Дата'].dropna()
+            if not dates.empty:
+                month_name = RUSSIAN_MONTHS.get(dates.iloc[0].month, '')
+
+        sheet_name = unique_sheet_name(f"{car_plate} {month_name}".strip(), used_names if used_names is not None else set())
+        sheet_title = f"Отчет по машине {car_plate} за {month_name}"
+
+    with metrics.phase('render'):
+        worksheet = workbook.add_worksheet(sheet_name)
 
         # --- Заголовок отчета ---
-        worksheet.merge_range('A1:D1', sheet_title, title_format)
+        worksheet.merge_range('A1:D1', sheet_title, formats['title'])
         worksheet.set_row(0, 30) # Высота строки для заголовка
 
         # --- Заголовки таблицы ---
-        worksheet.write_row('A2', final_df.columns, header_format)
+        worksheet.write_row('A2', final_df.columns, formats['header'])
 
-        # --- Данные таблицы (запись вручную для применения форматов) ---
-        for row_num, data in enumerate(final_df.itertuples(index=False), 3):
-            worksheet.write(f'A{row_num}', data[0], date_border_format) # Дата
-            worksheet.write(f'B{row_num}', data[1], cell_border_format) # Маршрут
-            worksheet.write(f'C{row_num}', data[2], currency_border_format) # Стоимость
-            if pd.notna(data[3]):
-                worksheet.write(f'D{row_num}', data[3], currency_border_format) # ЗП Водителя
-            else:
-                worksheet.write(f'D{row_num}', '', cell_border_format) # Пустая ячейка с рамкой
+        # --- Данные таблицы: по колонке за вызов, у каждой свой формат ---
+        worksheet.write_column('A3', column_values(final_df['Дата']), formats['date_border'])
+        worksheet.write_column('B3', column_values(final_df['Маршрут']), formats['cell_border'])
+        worksheet.write_column('C3', column_values(final_df['Стоимость']), formats['currency_border'])
+        worksheet.write_column('D3', column_values(final_df['ЗП Водителя']), formats['currency_border'])
 
         # --- Настройка ширины колонок ---
         worksheet.set_column('A:A', 12)
@@ -133,16 +179,53 @@ async def create_car_report_excel(df: pd.DataFrame, car_plate: str) -> io.BytesI
 
         # --- Итоги под таблицей ---
         summary_start_row = len(final_df) + 4
-        worksheet.write(summary_start_row, 1, "Итого:", summary_label_format)
-        worksheet.write(summary_start_row, 2, total_cost, summary_value_format)
-        worksheet.write(summary_start_row, 3, total_driver_earnings, summary_value_format)
-        
-        worksheet.write(summary_start_row + 1, 1, "Налог (11%):", summary_label_format)
-        worksheet.write_formula(summary_start_row + 1, 2, f'=C{summary_start_row+1}*0.11', summary_value_format, tax)
-        
-        worksheet.write(summary_start_row + 2, 1, "Прибыль:", summary_label_format)
-        worksheet.write_formula(summary_start_row + 2, 2, f'=C{summary_start_row+1}-D{summary_start_row+1}-C{summary_start_row+2}', summary_value_format, profit)
+        worksheet.write(summary_start_row, 1, "Итого:", formats['summary_label'])
+        worksheet.write(summary_start_row, 2, total_cost, formats['summary_value'])
+        worksheet.write(summary_start_row, 3, total_driver_earnings, formats['summary_value'])
+
+        worksheet.write(summary_start_row + 1, 1, "Налог (11%):", formats['summary_label'])
+        worksheet.write_formula(summary_start_row + 1, 2, f'=C{summary_start_row+1}*0.11', formats['summary_value'], tax)
+
+        worksheet.write(summary_start_row + 2, 1, "Прибыль:", formats['summary_label'])
+        worksheet.write_formula(summary_start_row + 2, 2, f'=C{summary_start_row+1}-D{summary_start_row+1}-C{summary_start_row+2}', formats['summary_value'], profit)
+
+    return {'trips': len(final_df), 'cost': total_cost, 'earnings': total_driver_earnings, 'tax': tax, 'profit': profit}
 
+async def create_car_report_excel(df: pd.DataFrame, car_plate: str, month_name: str = None) -> io.BytesIO:
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        write_car_sheet(writer.book, get_report_formats(writer.book), df, car_plate, month_name)
+    output.seek(0)
+    return output
+
+FLEET_SUMMARY_COLUMNS = ["Машина", "Поездок", "Стоимость", "ЗП водителей", "Налог (11%)", "Прибыль"]
+async def create_fleet_report_excel(df: pd.DataFrame, month_name: str = None, period_label: str = None) -> io.BytesIO:
+    """Отчет по всему автопарку за один проход: лист 'Сводка' и по листу на каждую машину."""
+    output = io.BytesIO()
+    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
+        workbook = writer.book
+        formats = get_report_formats(workbook)
+        summary = workbook.add_worksheet("Сводка")
+        used_names = {"сводка"}
+        totals = [(plate, write_car_sheet(workbook, formats, car_df, str(plate), month_name, used_names))
+                  for plate, car_df in df.groupby('Гос_номер', observed=True, sort=True)]
+
+        with metrics.phase('render'):
+            summary.merge_range('A1:F1', f"Сводка по автопарку за {period_label or 'все время'}", formats['title'])
+            summary.set_row(0, 30)
+            summary.write_row('A2', FLEET_SUMMARY_COLUMNS, formats['header'])
+            summary.write_column('A3', [str(plate) for plate, _ in totals], formats['cell_border'])
+            summary.write_column('B3', [t['trips'] for _, t in totals], formats['cell_border'])
+            for col, key in enumerate(('cost', 'earnings', 'tax', 'profit'), 2):
+                summary.write_column(2, col, [float(t[key]) for _, t in totals], formats['currency_border'])
+            total_row = len(totals) + 2
+            summary.write(total_row, 0, "Итого:", formats['summary_label'])
+            for col, key in enumerate(('trips', 'cost', 'earnings', 'tax', 'profit'), 1):
+                letter = chr(ord('A') + col)
+                value = sum(float(t[key]) for _, t in totals)
+                summary.write_formula(total_row, col, f'=SUM({letter}3:{letter}{total_row})', formats['summary_value'], value)
+            summary.set_column('A:A', 12)
+            summary.set_column('B:F', 15)
     output.seek(0)
     return output
 
@@ -161,6 +244,7 @@ def get_main_menu_keyboard():
         [InlineKeyboardButton("👤 Статистика по фамилии", callback_data='main_ask_driver_stats')],
         [InlineKeyboardButton("📥 Экспорт в Excel", callback_data='main_export_menu')],
         [InlineKeyboardButton("🏆 Топ-5", callback_data='main_top')],
+        [InlineKeyboardButton("📅 Выбрать период", callback_data='main_period')],
         [InlineKeyboardButton("🗑️ Очистить данные", callback_data='main_clear')],
     ])
 def get_export_menu_keyboard():
@@ -168,22 +252,30 @@ def get_export_menu_keyboard():
         [InlineKeyboardButton("📄 Полный отчет", callback_data='export_full')],
         [InlineKeyboardButton("🚗 По гос. номеру (кастомный)", callback_data='export_ask_car')],
         [InlineKeyboardButton("👤 По фамилии", callback_data='export_ask_driver')],
+        [InlineKeyboardButton("🚛 Весь автопарк (лист на машину)", callback_data='export_fleet')],
         [InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_main_menu')],
     ])
 
+@metrics.timed_handler
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db.get_or_create_user(update)
     user_id = update.effective_user.id
     welcome_text = ( "👋 **Аналитический бот v7.1**\n\nВыберите действие:")
-    df = await db.get_all_trips_as_df(user_id)
-    if not df.empty:
-        processed_files = await db.get_processed_files(user_id)
-        welcome_text += (f"\n\n**Текущая сессия:**\n▫️ Загружено файлов: {len(processed_files)}\n▫️ Всего записей: {len(df)}\n▫️ Общий доход: *{df['Стоимость'].sum():,.0f} руб.*")
+    date_from, date_to, period_label = get_period(context)
+    if period_label:
+        welcome_text += f"\n\n📅 Период: *{period_label}*"
+    stats = await db.get_user_stats(user_id, date_from, date_to)
+    if stats['trips']:
+        welcome_text += (f"\n\n**Текущая сессия:**\n▫️ Загружено файлов: {stats['files']}\n▫️ Всего записей: {stats['trips']}\n▫️ Общий доход: *{stats['total']:,.0f} руб.*")
     if update.callback_query:
         await update.callback_query.edit_message_text(welcome_text, reply_markup=get_main_menu_keyboard(), parse_mode='Markdown')
     else:
         await update.message.reply_text(welcome_text, reply_markup=get_main_menu_keyboard(), parse_mode='Markdown')
     return ConversationHandler.END
+# Под нагрузкой (см. health.overloaded) тяжелые запросы сразу отклоняются, а не копятся в очереди
+HEAVY_COMMANDS = ('export_full', 'export_fleet')
+BUSY_TEXT = "⏳ Бот сейчас перегружен. Повторите запрос через минуту."
+@metrics.timed_handler
 async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db.get_or_create_user(update)
     query = update.callback_query
@@ -191,43 +283,64 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user_id = query.from_user.id
     command = query.data
     try:
-        df = await db.get_all_trips_as_df(user_id)
-        has_data = not df.empty
         if command == 'back_to_main_menu':
             await start(update, context)
             return
         if command == 'main_export_menu':
             await query.edit_message_text("📥 **Экспорт в Excel**\n\nВыберите тип отчета:", reply_markup=get_export_menu_keyboard(), parse_mode='Markdown')
             return
+        if command == 'main_period':
+            months = await db.get_available_months(user_id)
+            await query.edit_message_text("📅 Выберите месяц для статистики и отчетов:", reply_markup=get_period_keyboard(months))
+            return
+        if command.startswith('period_'):
+            period = command.split('_', 1)[1]
+            if period == 'all': context.user_data.pop('period', None)
+            else: context.user_data['period'] = period
+            await start(update, context)
+            return
         if command == 'main_clear':
             await db.clear_user_data(user_id)
             await query.edit_message_text("🗑️ Все загруженные данные удалены.", reply_markup=back_to_main_menu_keyboard)
             return
-        if not has_data:
-            await query.edit_message_text("ℹ️ Данные для анализа отсутствуют. Загрузите файлы.", reply_markup=back_to_main_menu_keyboard)
+        if command in HEAVY_COMMANDS and health.overloaded():
+            await query.edit_message_text(BUSY_TEXT, reply_markup=back_to_main_menu_keyboard)
+            return
+        date_from, date_to, period_label = get_period(context)
+        stats = await db.get_user_stats(user_id, date_from, date_to)
+        if not stats['trips']:
+            text = f"ℹ️ За {period_label} поездок нет. Выберите другой период." if period_label else "ℹ️ Данные для анализа отсутствуют. Загрузите файлы."
+            await query.edit_message_text(text, reply_markup=back_to_main_menu_keyboard)
             return
+        period_title = f" за {period_label}" if period_label else ""
         if command == 'main_stats':
-            processed_files = await db.get_processed_files(user_id)
-            message = (f"📊 *Общая статистика*\n\n▫️ Обработано файлов: {len(processed_files)}\n▫️ Всего маршрутов: {len(df)}\n▫️ Общий заработок: *{df['Стоимость'].sum():,.2f} руб.*\n▫️ Уникальных машин: {df['Гос_номер'].nunique()}\n▫️ Уникальных водителей: {df['Водитель'].nunique()}")
+            message = (f"📊 *Общая статистика{period_title}*\n\n▫️ Обработано файлов: {stats['files']}\n▫️ Всего маршрутов: {stats['trips']}\n▫️ Общий заработок: *{stats['total']:,.2f} руб.*\n▫️ Уникальных машин: {stats['cars']}\n▫️ Уникальных водителей: {stats['drivers']}")
             await query.edit_message_text(message, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
         elif command == 'main_top':
-            top_drivers = df.groupby('Водитель')['Стоимость'].sum().nlargest(5)
-            top_drivers_text = "".join([f"{i}. {d} - {t:,.0f} руб.\n" for i, (d, t) in enumerate(top_drivers.items(), 1)])
-            top_cars = df.groupby('Гос_номер')['Стоимость'].sum().nlargest(5)
-            top_cars_text = "".join([f"{i}. Номер {c} - {t:,.0f} руб.\n" for i, (c, t) in enumerate(top_cars.items(), 1)])
-            message = (f"🏆 *Топ-5 по заработку*\n\n👤 *Лучшие водители:*\n{top_drivers_text or 'Нет данных'}\n🚗 *Самые прибыльные машины:*\n{top_cars_text or 'Нет данных'}")
+            top_drivers = await db.get_totals_by(user_id, 'driver', 5, date_from, date_to)
+            top_drivers_text = "".join([f"{i}. {d} - {t:,.0f} руб.\n" for i, (d, t) in enumerate(top_drivers, 1)])
+            top_cars = await db.get_totals_by(user_id, 'car', 5, date_from, date_to)
+            top_cars_text = "".join([f"{i}. Номер {c} - {t:,.0f} руб.\n" for i, (c, t) in enumerate(top_cars, 1)])
+            message = (f"🏆 *Топ-5 по заработку{period_title}*\n\n👤 *Лучшие водители:*\n{top_drivers_text or 'Нет данных'}\n🚗 *Самые прибыльные машины:*\n{top_cars_text or 'Нет данных'}")
             await query.edit_message_text(message, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
         elif command == 'export_full':
-            await send_excel_report(df, query.message.chat_id, context, "полный_отчет.xlsx")
+            filename = f"полный_отчет_{context.user_data['period']}.xlsx" if period_label else "полный_отчет.xlsx"
+            await send_excel_report(user_id, query.message.chat_id, context, filename, date_from=date_from, date_to=date_to)
+            await context.bot.send_message(query.message.chat_id, "Выберите следующее действие:", reply_markup=back_to_main_menu_keyboard)
+        elif command == 'export_fleet':
+            # Одна выборка на весь автопарк, дальше группировка по машинам в памяти
+            async def build():
+                if period_label:
+                    df = await db.get_trips_df(user_id, date_from=date_from, date_to=date_to)
+                else:
+                    df = await db.get_all_trips_as_df(user_id)
+                report_buffer = await create_fleet_report_excel(df, RUSSIAN_MONTHS[date_from.month] if period_label else None, period_label)
+                return report_buffer, f"📊 Отчет по автопарку готов: {df['Гос_номер'].nunique()} машин."
+            filename = f"автопарк_{context.user_data['period']}.xlsx" if period_label else "автопарк.xlsx"
+            await report_cache.send_report(context.bot, query.message.chat_id, user_id, 'fleet', (date_from, date_to), build, filename)
             await context.bot.send_message(query.message.chat_id, "Выберите следующее действие:", reply_markup=back_to_main_menu_keyboard)
-        elif command == 'summary_car' or command == 'summary_driver':
-            group_by_col = 'Гос_номер' if command == 'summary_car' else 'Водитель'
-            title = "🚗 Сводка по автомобилям" if command == 'summary_car' else "👤 Сводка по водителям"
-            summary = df.groupby(group_by_col)['Стоимость'].sum().sort_values(ascending=False)
-            summary_text = f"**{title}**\n\n"
-            for item, total in summary.items():
-                summary_text += f"▫️ {item}: *{total:,.0f} руб.*\n"
-            await query.edit_message_text(summary_text, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
+        elif command in ('summary_car', 'summary_driver', 'summary_next', 'summary_prev'):
+            await show_summary_page(query, context, user_id, command, period_title)
     except BadRequest as e:
         if "Message is not modified" in str(e): logging.info("Ignoring 'Message is not modified' error.")
         else: logging.error(f"An unexpected BadRequest error occurred: {e}")
@@ -235,6 +348,39 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         logging.error(f"An error occurred in button_callback: {e}")
         try: await query.edit_message_text("❌ Произошла ошибка.", reply_markup=back_to_main_menu_keyboard)
         except Exception as e2: logging.error(f"Could not send error message to user: {e2}")
+# Сводки по машинам/водителям показываются страницами: длинная упиралась в лимит 4096 символов
+SUMMARY_PAGE_SIZE = 30
+SUMMARY_TITLES = {'car': "🚗 Сводка по автомобилям", 'driver': "👤 Сводка по водителям"}
+async def show_summary_page(query, context: ContextTypes.DEFAULT_TYPE, user_id: int, command: str, period_title: str):
+    """Первая страница сводки (summary_car/summary_driver) или соседняя (summary_next/summary_prev)."""
+    date_from, date_to, _ = get_period(context)
+    state = context.user_data.get('summary')
+    if command in ('summary_next', 'summary_prev') and state:
+        forward = command == 'summary_next'
+        rows, more = await db.get_totals_page(user_id, state['group_by'], SUMMARY_PAGE_SIZE,
+                                              after=state['last'] if forward else None, before=None if forward else state['first'],
+                                              date_from=date_from, date_to=date_to)
+        page = state['page'] + (1 if forward else -1)
+        has_prev, has_next = (True, more) if forward else (more, True)
+    else:
+        rows = []
+    if not rows:
+        # Первая страница, или данные изменились и соседней страницы больше нет
+        group_by = {'summary_car': 'car', 'summary_driver': 'driver'}.get(command) or (state or {}).get('group_by', 'car')
+        state = {'group_by': group_by}
+        rows, has_next = await db.get_totals_page(user_id, group_by, SUMMARY_PAGE_SIZE, date_from=date_from, date_to=date_to)
+        page, has_prev = 0, False
+    state.update(page=page, first=list(rows[0]) if rows else None, last=list(rows[-1]) if rows else None)
+    context.user_data['summary'] = state
+    summary_text = f"**{SUMMARY_TITLES[state['group_by']]}{period_title}**\n\n"
+    summary_text += "".join(f"▫️ {item}: *{total:,.0f} руб.*\n" for item, total in rows)
+    if has_prev or has_next:
+        summary_text += f"\nСтраница {page + 1}"
+    navigation = ([InlineKeyboardButton("⬅️ Назад", callback_data='summary_prev')] if has_prev else []) + \
+                 ([InlineKeyboardButton("Далее ➡️", callback_data='summary_next')] if has_next else [])
+    keyboard = ([navigation] if navigation else []) + [[InlineKeyboardButton("⬅️ Назад в главное меню", callback_data='back_to_main_menu')]]
+    await query.edit_message_text(summary_text, parse_mode='Markdown', reply_markup=InlineKeyboardMarkup(keyboard))
+@metrics.timed_handler
 async def ask_for_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db.get_or_create_user(update)
     query = update.callback_query
@@ -252,106 +398,253 @@ async def ask_for_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action == 'export_ask_driver':
         await query.edit_message_text("👤 Введите фамилию для создания отчета:", reply_markup=cancel_keyboard)
         return ASK_DRIVER_EXPORT
-async def handle_car_stats_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+async def resolve_search_input(update: Update, context: ContextTypes.DEFAULT_TYPE, group_by: str, state: int, not_found_text: str):
+    """Ищет введенный номер/фамилию. Возвращает точное имя или None (тогда пользователь уже получил ответ)."""
+    user_input = update.message.text.strip()
+    matches = await db.search_items(update.effective_user.id, group_by, user_input)
+    exact = [m for m in matches if str(m).lower() == user_input.lower()]
+    if exact or len(matches) == 1:
+        return (exact or matches)[0]
+    if not matches:
+        await update.message.reply_text(not_found_text.format(user_input), reply_markup=cancel_keyboard)
+        return None
+    context.user_data['suggestions'] = matches
+    context.user_data['suggestions_state'] = state
+    keyboard = [[InlineKeyboardButton(str(m), callback_data=f'pick_{i}')] for i, m in enumerate(matches)]
+    keyboard.append([InlineKeyboardButton("❌ Отмена", callback_data='cancel_conversation')])
+    await update.message.reply_text(f"🔎 По запросу '{user_input}' найдено несколько вариантов, выберите нужный:", reply_markup=InlineKeyboardMarkup(keyboard))
+    return None
+async def send_car_stats(message, context: ContextTypes.DEFAULT_TYPE, user_id: int, plate: str):
+    date_from, date_to, period_label = get_period(context)
+    stats = await db.get_item_stats(user_id, 'car', plate, date_from, date_to)
+    text = (f"🚗 *Статистика по машине {plate}{f' за {period_label}' if period_label else ''}*\n\n▫️ Совершено маршрутов: {stats['trips']}\n▫️ Общий заработок: *{stats['total']:,.2f} руб.*\n▫️ Водители: {', '.join(stats['related'])}")
+    await message.reply_text(text, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
+async def send_driver_stats(message, context: ContextTypes.DEFAULT_TYPE, user_id: int, driver: str):
+    date_from, date_to, period_label = get_period(context)
+    stats = await db.get_item_stats(user_id, 'driver', driver, date_from, date_to)
+    text = (f"👤 *Статистика по водителю {driver}{f' за {period_label}' if period_label else ''}*\n\n▫️ Совершено маршрутов: {stats['trips']}\n▫️ Общий заработок: *{stats['total']:,.2f} руб.*\n▫️ Машины: {', '.join(stats['related'])}")
+    await message.reply_text(text, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
+async def send_car_export(message, context: ContextTypes.DEFAULT_TYPE, user_id: int, plate: str):
+    if health.overloaded():
+        await message.reply_text(BUSY_TEXT, reply_markup=back_to_main_menu_keyboard)
+        return
+    date_from, date_to, period_label = get_period(context)
+    async def build():
+        if period_label:
+            # Месячный отчет читает только партицию этого месяца
+            car_df = await db.get_trips_df(user_id, 'car', plate, date_from, date_to)
+            if car_df.empty: return None
+            month_name = RUSSIAN_MONTHS[date_from.month]
+        else:
+            df = await db.get_all_trips_as_df(user_id)
+            car_df = df[df['Гос_номер'] == plate]
+            month_name = None
+        return await create_car_report_excel(car_df, plate, month_name), f"📊 Ваш кастомный отчет по машине {plate} готов."
+    if not await report_cache.send_report(context.bot, message.chat_id, user_id, 'car', (plate, date_from, date_to), build, f"отчет_{plate}.xlsx"):
+        await message.reply_text(f"ℹ️ У машины {plate} нет поездок за {period_label}.", reply_markup=back_to_main_menu_keyboard)
+        return
+    await message.reply_text("Выберите следующее действие:", reply_markup=back_to_main_menu_keyboard)
+async def send_driver_export(message, context: ContextTypes.DEFAULT_TYPE, user_id: int, driver: str):
+    if health.overloaded():
+        await message.reply_text(BUSY_TEXT, reply_markup=back_to_main_menu_keyboard)
+        return
+    date_from, date_to, _ = get_period(context)
+    await send_excel_report(user_id, message.chat_id, context, f"отчет_водитель_{driver}.xlsx", group_by='driver', name=driver, date_from=date_from, date_to=date_to)
+    await message.reply_text("Выберите следующее действие:", reply_markup=back_to_main_menu_keyboard)
+# Состояние диалога -> (что ищем, что делать с найденным, текст "не найдено")
+SEARCH_ACTIONS = {
+    ASK_CAR_STATS: ('car', send_car_stats, "❌ Машина с номером '{}' не найдена. Попробуйте еще раз или нажмите 'Отмена'."),
+    ASK_DRIVER_STATS: ('driver', send_driver_stats, "❌ Водитель '{}' не найден. Попробуйте еще раз или нажмите 'Отмена'."),
+    ASK_CAR_EXPORT: ('car', send_car_export, "❌ Машина '{}' не найдена. Попробуйте еще раз или отмените экспорт."),
+    ASK_DRIVER_EXPORT: ('driver', send_driver_export, "❌ Водитель '{}' не найден. Попробуйте еще раз или отмените экспорт."),
+}
+async def handle_search_input(update: Update, context: ContextTypes.DEFAULT_TYPE, state: int):
     await db.get_or_create_user(update)
-    user_input = update.message.text
-    user_id = update.effective_user.id
-    df = await db.get_all_trips_as_df(user_id)
-    car_df = df[df['Гос_номер'].astype(str).str.contains(user_input, case=False, na=False)]
-    if car_df.empty:
-        await update.message.reply_text(f"❌ Машина с номером '{user_input}' не найдена. Попробуйте еще раз или нажмите 'Отмена'.", reply_markup=cancel_keyboard)
-        return ASK_CAR_STATS
-    drivers = ", ".join(car_df['Водитель'].unique())
-    message = (f"🚗 *Статистика по машине {user_input}*\n\n▫️ Совершено маршрутов: {len(car_df)}\n▫️ Общий заработок: *{car_df['Стоимость'].sum():,.2f} руб.*\n▫️ Водители: {drivers}")
-    await update.message.reply_text(message, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
+    group_by, action, not_found_text = SEARCH_ACTIONS[state]
+    name = await resolve_search_input(update, context, group_by, state, not_found_text)
+    if name is None:
+        return state
+    await action(update.message, context, update.effective_user.id, name)
     return ConversationHandler.END
+@metrics.timed_handler
+async def handle_car_stats_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await handle_search_input(update, context, ASK_CAR_STATS)
+@metrics.timed_handler
 async def handle_driver_stats_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await db.get_or_create_user(update)
-    user_input = update.message.text
-    user_id = update.effective_user.id
-    df = await db.get_all_trips_as_df(user_id)
-    driver_df = df[df['Водитель'].str.contains(user_input, case=False, na=False)]
-    if driver_df.empty:
-        await update.message.reply_text(f"❌ Водитель '{user_input}' не найден. Попробуйте еще раз или нажмите 'Отмена'.", reply_markup=cancel_keyboard)
-        return ASK_DRIVER_STATS
-    cars = ", ".join(driver_df['Гос_номер'].unique())
-    message = (f"👤 *Статистика по водителю {user_input}*\n\n▫️ Совершено маршрутов: {len(driver_df)}\n▫️ Общий заработок: *{driver_df['Стоимость'].sum():,.2f} руб.*\n▫️ Машины: {cars}")
-    await update.message.reply_text(message, parse_mode='Markdown', reply_markup=back_to_main_menu_keyboard)
-    return ConversationHandler.END
+    return await handle_search_input(update, context, ASK_DRIVER_STATS)
+@metrics.timed_handler
 async def handle_car_export_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await db.get_or_create_user(update)
-    user_input = update.message.text
-    user_id = update.effective_user.id
-    df = await db.get_all_trips_as_df(user_id)
-    car_df = df[df['Гос_номер'].astype(str).str.contains(user_input, case=False, na=False)]
-    if car_df.empty:
-        await update.message.reply_text(f"❌ Машина '{user_input}' не найдена. Попробуйте еще раз или отмените экспорт.", reply_markup=cancel_keyboard)
-        return ASK_CAR_EXPORT
-    report_buffer = await create_car_report_excel(car_df, user_input)
-    await context.bot.send_document(chat_id=update.message.chat_id, document=report_buffer, filename=f"отчет_{user_input}.xlsx", caption=f"📊 Ваш кастомный отчет по машине {user_input} готов.")
-    await update.message.reply_text("Выберите следующее действие:", reply_markup=back_to_main_menu_keyboard)
-    return ConversationHandler.END
+    return await handle_search_input(update, context, ASK_CAR_EXPORT)
+@metrics.timed_handler
 async def handle_driver_export_input(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    return await handle_search_input(update, context, ASK_DRIVER_EXPORT)
+@metrics.timed_handler
+async def handle_suggestion_pick(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db.get_or_create_user(update)
-    user_input = update.message.text
-    user_id = update.effective_user.id
-    df = await db.get_all_trips_as_df(user_id)
-    driver_df = df[df['Водитель'].str.contains(user_input, case=False, na=False)]
-    if driver_df.empty:
-        await update.message.reply_text(f"❌ Водитель '{user_input}' не найден. Попробуйте еще раз или отмените экспорт.", reply_markup=cancel_keyboard)
-        return ASK_DRIVER_EXPORT
-    await send_excel_report(driver_df, update.message.chat_id, context, f"отчет_водитель_{user_input}.xlsx")
-    await update.message.reply_text("Выберите следующее действие:", reply_markup=back_to_main_menu_keyboard)
+    query = update.callback_query
+    await query.answer()
+    suggestions = context.user_data.pop('suggestions', [])
+    state = context.user_data.pop('suggestions_state', None)
+    index = int(query.data.split('_', 1)[1])
+    if state not in SEARCH_ACTIONS or index >= len(suggestions):
+        await query.edit_message_text("⚠️ Список вариантов устарел. Начните заново.", reply_markup=back_to_main_menu_keyboard)
+        return ConversationHandler.END
+    _, action, _ = SEARCH_ACTIONS[state]
+    await query.edit_message_reply_markup(reply_markup=None)
+    await action(query.message, context, query.from_user.id, suggestions[index])
     return ConversationHandler.END
-async def send_excel_report(df: pd.DataFrame, chat_id: int, context: ContextTypes.DEFAULT_TYPE, filename: str):
-    output = io.BytesIO()
-    with pd.ExcelWriter(output, engine='xlsxwriter') as writer:
-        df.to_excel(writer, index=False, sheet_name='Отчет')
-        worksheet = writer.sheets['Отчет']
-        for idx, col in enumerate(df):
-            max_len = max((df[col].astype(str).map(len).max(), len(str(df[col].name)) + 1))
-            worksheet.set_column(idx, idx, max_len)
-    output.seek(0)
-    await context.bot.send_document(chat_id=chat_id, document=output, filename=filename, caption='📊 Ваш отчет готов.')
+async def send_excel_report(user_id: int, chat_id: int, context: ContextTypes.DEFAULT_TYPE, filename: str, group_by: str = None, name: str = None, date_from=None, date_to=None):
+    async def build():
+        with metrics.phase('render'):
+            output, _ = await export.export_trips_xlsx(user_id, group_by, name, date_from, date_to)
+        return output, '📊 Ваш отчет готов.'
+    await report_cache.send_report(context.bot, chat_id, user_id, 'trips', (group_by, name, date_from, date_to), build, filename)
+@metrics.timed_handler
+async def rebuild_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await db.get_or_create_user(update)
+    repaired = await db.repair_rollups(update.effective_user.id)
+    message = "🛠️ Статистика пересчитана заново." if repaired else "✅ Статистика в порядке, пересчет не нужен."
+    await update.message.reply_text(message, reply_markup=back_to_main_menu_keyboard)
+@metrics.timed_handler
 async def cancel_conversation(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db.get_or_create_user(update)
     query = update.callback_query
     await query.answer()
     await query.edit_message_text("Действие отменено.", reply_markup=back_to_main_menu_keyboard)
     return ConversationHandler.END
+# Документы альбома приходят отдельными обновлениями: ждем остальные и загружаем их одной пачкой
+MEDIA_GROUP_WAIT = float(os.getenv("MEDIA_GROUP_WAIT", 2))
+media_groups = {}  # media_group_id -> документы альбома, собранные до обработки
+@metrics.timed_handler
 async def handle_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db.get_or_create_user(update)
-    user_id = update.effective_user.id
-    file = await update.message.document.get_file()
-    file_name = update.message.document.file_name
-    processed_files = await db.get_processed_files(user_id)
-    if file_name in processed_files:
-        await update.message.reply_text(f"⚠️ Файл '{file_name}' уже был обработан ранее. Загрузка пропущена.")
+    message = update.message
+    group_id = message.media_group_id
+    if group_id is None:
+        await process_upload(message, update.effective_user.id, [message.document])
+        return
+    if group_id not in media_groups:
+        media_groups[group_id] = []
+        context.application.create_task(process_media_group(message, update.effective_user.id, group_id), update=update)
+    media_groups[group_id].append(message.document)
+async def process_media_group(message, user_id: int, group_id: str):
+    await asyncio.sleep(MEDIA_GROUP_WAIT)
+    await process_upload(message, user_id, media_groups.pop(group_id))
+async def download_document(document) -> bytes:
+    file = await document.get_file()
+    return bytes(await file.download_as_bytearray())
+async def process_upload(message, user_id: int, documents: list):
+    """
+    Загружает пачку документов (файл, ZIP-архив или альбом): одна проверка дублей, параллельный разбор,
+    одна транзакция на все поездки и один итоговый ответ с числами из результата вставки.
+    """
+    if health.overloaded():
+        await message.reply_text("⏳ Бот сейчас перегружен. Отправьте файлы еще раз через минуту.")
         return
-    await update.message.reply_text(f"⏳ Получил файл '{file_name}'. Обрабатываю...")
-    file_content = await file.download_as_bytearray()
-    new_df = process_excel_file(bytes(file_content), file_name)
-    if new_df is None or new_df.empty:
-        await update.message.reply_text(f"⚠️ Не удалось извлечь данные из файла '{file_name}'.")
+    skipped, failed = [], []  # (имя файла, с чем совпал) / (имя файла, причина)
+    # Повторную отправку тех же файлов в Telegram узнаем еще до скачивания
+    known = await db.find_processed_files(user_id, file_unique_ids=[d.file_unique_id for d in documents])
+    skipped += [(d.file_name, known[d.file_unique_id]) for d in documents if d.file_unique_id in known]
+    documents = [d for d in documents if d.file_unique_id not in known]
+    if not documents:
+        await message.reply_text(format_upload_summary([], skipped, failed, None))
         return
-    await db.add_trips_from_df(user_id, new_df)
-    full_df = await db.get_all_trips_as_df(user_id)
-    message_text = (f"✅ Файл '{file_name}' успешно обработан!\n"
-                    f"Добавлено записей: {len(new_df)}\n"
-                    f"Всего загружено: {len(full_df)}\n\n"
-                    "Что вы хотите сделать дальше?")
-    await update.message.reply_text(message_text, reply_markup=post_upload_keyboard)
-class HealthCheckHandler(BaseHTTPRequestHandler):
-    def do_GET(self): self.send_response(200); self.send_header("Content-type", "text/plain"); self.end_headers(); self.wfile.write(b"Bot is alive")
-    def do_HEAD(self): self.send_response(200); self.send_header("Content-type", "text/plain"); self.end_headers()
-    def log_message(self, format, *args): return
-def run_health_check_server():
-    port = int(os.environ.get("PORT", 8080)); httpd = HTTPServer(('', port), HealthCheckHandler); httpd.serve_forever()
+    waiting = ingest.queue_depth()
+    subject = f"файл '{documents[0].file_name}'" if len(documents) == 1 else f"файлов: {len(documents)}"
+    status_message = await message.reply_text(f"⏳ Получил {subject}. " + (f"В очереди на обработку (перед вами: {waiting})..." if waiting else "Обрабатываю..."))
+    contents = await asyncio.gather(*(download_document(d) for d in documents))
+    hashes = [hashlib.sha256(content).hexdigest() for content in contents]
+    # Тот же файл или архив, отправленный заново с другим file_unique_id, узнаем до распаковки и разбора
+    known = await db.find_processed_files(user_id, sha256s=hashes)
+    files = []  # (имя файла, содержимое, file_unique_id, sha256, индекс архива или None)
+    archives = {}  # индекс архива -> (документ, sha256)
+    for i, (document, content, sha256) in enumerate(zip(documents, contents, hashes)):
+        if sha256 in known:
+            skipped.append((document.file_name, known[sha256]))
+            continue
+        if not ingest.is_archive(document.file_name):
+            files.append((document.file_name, content, document.file_unique_id, sha256, None))
+            continue
+        try:
+            members = await asyncio.to_thread(ingest.expand_archive, content)
+        except ingest.ArchiveError as e:
+            failed.append((document.file_name, str(e)))
+            continue
+        if not members:
+            failed.append((document.file_name, "в архиве нет Excel-файлов"))
+            continue
+        archives[i] = (document, sha256)
+        files += [(name, data, None, hashlib.sha256(data).hexdigest(), i) for name, data in members]
+    # Файлы из архивов, загруженные ранее, и одинаковые файлы внутри пачки
+    if archives:
+        known.update(await db.find_processed_files(user_id, sha256s=[f[3] for f in files if f[4] is not None]))
+    unique = {}
+    for name, content, file_unique_id, sha256, archive in files:
+        if sha256 in known: skipped.append((name, known[sha256]))
+        elif sha256 in unique: skipped.append((name, unique[sha256][0]))
+        else: unique[sha256] = (name, content, file_unique_id, archive)
+    files = [(name, content, file_unique_id, sha256, archive) for sha256, (name, content, file_unique_id, archive) in unique.items()]
+    started = False
+    async def on_started():
+        nonlocal started
+        if waiting and not started:
+            started = True
+            await status_message.edit_text(f"⚙️ Обрабатываю {subject}...")
+    with metrics.phase('parse'):
+        results = await ingest.parse_batch(user_id, [(name, content) for name, content, _, _, _ in files], on_started=on_started)
+    batches, incomplete = [], set()  # incomplete - архивы, часть файлов которых не загрузилась
+    for (name, _, file_unique_id, sha256, archive), result in zip(files, results):
+        reason = None
+        if isinstance(result, ingest.ParseUserLimit): reason = "у вас уже обрабатываются другие файлы, отправьте этот еще раз позже"
+        elif isinstance(result, ingest.ParseQueueFull): reason = "бот перегружен, отправьте файл чуть позже"
+        elif isinstance(result, asyncio.TimeoutError): reason = "обрабатывался слишком долго"
+        elif isinstance(result, BaseException):
+            logging.error(f"Failed to parse '{name}': {result!r}")
+            reason = "файл не удалось обработать"
+        elif result is None or result.empty: reason = "не удалось извлечь данные"
+        if reason:
+            failed.append((name, reason))
+            incomplete.add(archive)
+        else:
+            batches.append((result, file_unique_id, sha256, name))
+    # Архив запоминаем, только если загрузились все его файлы: иначе повторная отправка должна пройти
+    complete_archives = [(document.file_unique_id, sha256, document.file_name) for i, (document, sha256) in archives.items() if i not in incomplete]
+    counts = await db.add_trip_batches(user_id, batches, complete_archives)
+    added = []
+    for (_, _, _, name), count in zip(batches, counts):
+        if count: added.append((name, count))
+        else: skipped.append((name, None))  # такой же файл параллельно загрузили в другом обновлении
+    stats = await db.get_user_stats(user_id) if added else None
+    await message.reply_text(format_upload_summary(added, skipped, failed, stats), reply_markup=post_upload_keyboard if added else None)
+UPLOAD_SUMMARY_LINES = 15  # строк на каждый список в итоговом ответе, чтобы не упереться в 4096 символов
+def limit_lines(lines: list) -> list:
+    if len(lines) <= UPLOAD_SUMMARY_LINES: return lines
+    return lines[:UPLOAD_SUMMARY_LINES] + [f"... и еще {len(lines) - UPLOAD_SUMMARY_LINES}"]
+def format_upload_summary(added: list, skipped: list, failed: list, stats: dict) -> str:
+    lines = []
+    if added:
+        if len(added) == 1 and not skipped and not failed:
+            lines.append(f"✅ Файл '{added[0][0]}' успешно обработан!")
+        else:
+            lines.append(f"✅ Обработано файлов: {len(added)}")
+            lines += limit_lines([f"▫️ {name}: {count}" for name, count in added])
+        lines.append(f"Добавлено записей: {sum(count for _, count in added)}")
+        lines.append(f"Всего загружено: {stats['trips']}")
+    lines += limit_lines([f"⚠️ Файл '{name}' уже был обработан ранее" + (f" (как '{known_name}')" if known_name and known_name != name else "") + ". Загрузка пропущена."
+                          for name, known_name in skipped])
+    lines += limit_lines([f"⚠️ Файл '{name}' пропущен: {reason}." for name, reason in failed])
+    if added:
+        lines.append("\nЧто вы хотите сделать дальше?")
+    return "\n".join(lines)
 
 if __name__ == '__main__':
     TOKEN = os.getenv('TELEGRAM_TOKEN')
     if not TOKEN: raise ValueError("Необходимо установить переменную окружения TELEGRAM_TOKEN")
-    application = ApplicationBuilder().token(TOKEN).post_init(post_init).build()
+    state_store = persistence.PostgresPersistence()
+    application = (ApplicationBuilder().token(TOKEN).request(metrics.TimedRequest())
+                   .concurrent_updates(dispatch.PerUserUpdateProcessor()).persistence(state_store)
+                   .rate_limiter(outbound.RateLimiter())
+                   .post_init(post_init).post_shutdown(post_shutdown).build())
     conv_handler = ConversationHandler(
         entry_points=[
             CallbackQueryHandler(ask_for_input, pattern='^main_ask_car_stats$'),
@@ -360,21 +653,36 @@ if __name__ == '__main__':
             CallbackQueryHandler(ask_for_input, pattern='^export_ask_driver$'),
         ],
         states={
-            ASK_CAR_STATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_car_stats_input)],
-            ASK_DRIVER_STATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_driver_stats_input)],
-            ASK_CAR_EXPORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_car_export_input)],
-            ASK_DRIVER_EXPORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_driver_export_input)],
+            ASK_CAR_STATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_car_stats_input), CallbackQueryHandler(handle_suggestion_pick, pattern=r'^pick_\d+$')],
+            ASK_DRIVER_STATS: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_driver_stats_input), CallbackQueryHandler(handle_suggestion_pick, pattern=r'^pick_\d+$')],
+            ASK_CAR_EXPORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_car_export_input), CallbackQueryHandler(handle_suggestion_pick, pattern=r'^pick_\d+$')],
+            ASK_DRIVER_EXPORT: [MessageHandler(filters.TEXT & ~filters.COMMAND, handle_driver_export_input), CallbackQueryHandler(handle_suggestion_pick, pattern=r'^pick_\d+$')],
         },
         fallbacks=[
             CommandHandler('start', start),
             CallbackQueryHandler(cancel_conversation, pattern='^cancel_conversation$')
         ],
-        per_message=False
+        per_message=False,
+        name='search', persistent=True
     )
     application.add_handler(CommandHandler('start', start))
+    application.add_handler(CommandHandler('rebuild_stats', rebuild_stats))
     application.add_handler(conv_handler)
     application.add_handler(CallbackQueryHandler(button_handler))
     application.add_handler(MessageHandler(filters.Document.ALL, handle_document))
-    threading.Thread(target=run_health_check_server, daemon=True).start()
+    state_store.register_handlers(application)
     print("Бот запущен в финальной версии (v7.0 - Кастомные отчеты)...")
-    application.run_polling()
+    # WEBHOOK_URL - публичный адрес, на который Telegram будет слать обновления вместо long polling.
+    # Несколько реплик возможны только в этом режиме: getUpdates Telegram отдает одному клиенту.
+    webhook_url = os.getenv('WEBHOOK_URL')
+    if webhook_url:
+        webhook_path = os.getenv('WEBHOOK_PATH', 'telegram')
+        application.run_webhook(
+            listen='0.0.0.0',
+            port=int(os.getenv('WEBHOOK_PORT', 8443)),
+            url_path=webhook_path,
+            webhook_url=f"{webhook_url.rstrip('/')}/{webhook_path}",
+            secret_token=os.getenv('WEBHOOK_SECRET'),
+        )
+    else:
+        application.run_polling()
@@ -1,13 +1,82 @@
 # db.py (Версия 6.2 - ФИНАЛЬНЫЙ ИСПРАВЛЕННЫЙ)
 
 import os
+import io
+import json
+import uuid
+import time
+import asyncio
 import logging
+import bisect
+from collections import OrderedDict
+from datetime import date, datetime, timedelta, timezone
+from contextlib import asynccontextmanager
 import asyncpg
 import pandas as pd
-from datetime import datetime
 from telegram import Update
+import metrics
 
 pool = None
+pool_waiters = 0  # корутины, ждущие свободное соединение в acquire()
+
+# --- Кэш DataFrame'ов поездок по пользователям ---
+TRIPS_CACHE_MAX_USERS = int(os.getenv("TRIPS_CACHE_MAX_USERS", 256))
+TRIPS_CACHE_MAX_BYTES = int(os.getenv("TRIPS_CACHE_MAX_MB", 256)) * 1024 * 1024
+
+data_versions = {}           # user_id -> версия данных, растет при каждом изменении поездок
+trips_cache = OrderedDict()  # user_id -> (версия, DataFrame, размер в байтах), порядок = LRU
+trips_cache_bytes = 0
+trips_cache_stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+
+def get_data_version(user_id: int) -> int:
+    return data_versions.get(user_id, 0)
+
+def invalidate_user(user_id: int):
+    """Поднимает версию данных пользователя и выбрасывает его DataFrame из кэша."""
+    global trips_cache_bytes
+    data_versions[user_id] = get_data_version(user_id) + 1
+    entry = trips_cache.pop(user_id, None)
+    if entry:
+        trips_cache_bytes -= entry[2]
+
+def _cache_put(user_id: int, version: int, df: pd.DataFrame):
+    global trips_cache_bytes
+    size = int(df.memory_usage(index=True, deep=True).sum())
+    if size > TRIPS_CACHE_MAX_BYTES: return
+    old = trips_cache.pop(user_id, None)
+    if old:
+        trips_cache_bytes -= old[2]
+    trips_cache[user_id] = (version, df, size)
+    trips_cache_bytes += size
+    while len(trips_cache) > TRIPS_CACHE_MAX_USERS or trips_cache_bytes > TRIPS_CACHE_MAX_BYTES:
+        _, (_, _, evicted_size) = trips_cache.popitem(last=False)
+        trips_cache_bytes -= evicted_size
+        trips_cache_stats['evictions'] += 1
+
+def _cache_metrics() -> list:
+    return [
+        "# TYPE bot_trips_cache_hits_total counter", f"bot_trips_cache_hits_total {trips_cache_stats['hits']}",
+        "# TYPE bot_trips_cache_misses_total counter", f"bot_trips_cache_misses_total {trips_cache_stats['misses']}",
+        "# TYPE bot_trips_cache_evictions_total counter", f"bot_trips_cache_evictions_total {trips_cache_stats['evictions']}",
+        "# TYPE bot_trips_cache_bytes gauge", f"bot_trips_cache_bytes {trips_cache_bytes}",
+    ]
+metrics.collectors.append(_cache_metrics)
+
+@asynccontextmanager
+async def acquire():
+    """pool.acquire() с замером ожидания свободного соединения."""
+    global pool_waiters
+    started = time.perf_counter()
+    pool_waiters += 1
+    try:
+        conn = await pool.acquire()
+    finally:
+        pool_waiters -= 1
+    metrics.pool_acquire_wait.observe(time.perf_counter() - started)
+    try:
+        yield conn
+    finally:
+        await pool.release(conn)
 
 async def init_db():
     """Создает все необходимые таблицы с правильными связями."""
@@ -15,22 +84,16 @@ async def init_db():
     if pool is not None: return True
     try:
         pool = await asyncpg.create_pool(dsn=os.getenv("DATABASE_URL"))
-        async with pool.acquire() as conn:
+        async with acquire() as conn:
             await conn.execute("CREATE TABLE IF NOT EXISTS users (user_id BIGINT PRIMARY KEY, first_name TEXT, last_name TEXT, username TEXT, first_seen TIMESTAMPTZ DEFAULT NOW(), last_seen TIMESTAMPTZ DEFAULT NOW());")
             await conn.execute("CREATE TABLE IF NOT EXISTS cars (car_id SERIAL PRIMARY KEY, plate_number TEXT NOT NULL UNIQUE);")
             await conn.execute("CREATE TABLE IF NOT EXISTS drivers (driver_id SERIAL PRIMARY KEY, name TEXT NOT NULL UNIQUE);")
-            await conn.execute("""
-                CREATE TABLE IF NOT EXISTS trips (
-                    trip_id SERIAL PRIMARY KEY,
-                    user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
-                    car_id INT REFERENCES cars(car_id) ON DELETE RESTRICT,
-                    driver_id INT REFERENCES drivers(driver_id) ON DELETE RESTRICT,
-                    source_file TEXT,
-                    trip_date DATE,
-                    route TEXT,
-                    amount REAL
-                );
-            """)
+            await create_trips_table(conn)
+            files_backfilled = await create_files_table(conn)
+            rollups_outdated = await create_rollup_tables(conn)
+            await create_state_tables(conn)
+            if rollups_outdated or files_backfilled:
+                await rebuild_rollups(conn)
         logging.info("Database tables initialized successfully.")
         return True
     except Exception as e:
@@ -38,11 +101,28 @@ async def init_db():
         pool = None
         return False
 
+# --- Активность пользователей: запись в users откладывается и идет пачками ---
+USER_FLUSH_INTERVAL = float(os.getenv("USER_FLUSH_INTERVAL", 30))
+KNOWN_PROFILES_MAX = int(os.getenv("KNOWN_PROFILES_MAX", 10000))
+
+known_profiles = OrderedDict()  # user_id -> (first_name, last_name, username), уже записанные в БД, порядок = LRU
+pending_users = {}   # user_id -> (first_name, last_name, username, last_seen), ждут сброса
+user_flush_task = None
+
+@metrics.timed_db
 async def get_or_create_user(update: Update):
-    """Обновляет или создает пользователя в БД при каждом его действии."""
+    """
+    Отмечает активность пользователя. В БД синхронно пишется только первое появление
+    пользователя в процессе (на users ссылаются поездки), остальное - через flush_user_activity.
+    """
     user = update.effective_user
     if not pool or not user: return
-    async with pool.acquire() as conn:
+    profile = (user.first_name, user.last_name, user.username)
+    if user.id in known_profiles:
+        known_profiles.move_to_end(user.id)
+        pending_users[user.id] = profile + (datetime.now(timezone.utc),)
+        return
+    async with acquire() as conn:
         await conn.execute("""
             INSERT INTO users (user_id, first_name, last_name, username, last_seen)
             VALUES ($1, $2, $3, $4, NOW())
@@ -51,70 +131,899 @@ async def get_or_create_user(update: Update):
                 last_name = EXCLUDED.last_name,
                 username = EXCLUDED.username,
                 last_seen = NOW();
-        """, user.id, user.first_name, user.last_name, user.username)
+        """, user.id, *profile)
+    _remember_profile(user.id, profile)
+
+def _remember_profile(user_id: int, profile: tuple):
+    # Забытый пользователь при следующем обновлении просто снова запишется синхронно
+    known_profiles[user_id] = profile
+    known_profiles.move_to_end(user_id)
+    while len(known_profiles) > KNOWN_PROFILES_MAX:
+        known_profiles.popitem(last=False)
+
+@metrics.timed_db
+async def flush_user_activity():
+    """Сбрасывает накопленные last_seen и изменения профилей одним multi-row upsert'ом."""
+    global pending_users
+    if not pool or not pending_users: return
+    batch, pending_users = pending_users, {}
+    user_ids = list(batch)
+    try:
+        async with acquire() as conn:
+            await conn.execute("""
+                INSERT INTO users (user_id, first_name, last_name, username, last_seen)
+                SELECT * FROM unnest($1::bigint[], $2::text[], $3::text[], $4::text[], $5::timestamptz[])
+                ON CONFLICT (user_id) DO UPDATE SET
+                    first_name = EXCLUDED.first_name,
+                    last_name = EXCLUDED.last_name,
+                    username = EXCLUDED.username,
+                    last_seen = GREATEST(users.last_seen, EXCLUDED.last_seen);
+            """, user_ids, *([batch[u][i] for u in user_ids] for i in range(4)))
+    except Exception as e:
+        logging.error(f"Failed to flush user activity: {e}")
+        # Возвращаем несброшенное, не затирая более свежие отметки
+        for user_id, entry in batch.items():
+            pending_users.setdefault(user_id, entry)
+        return
+    for user_id in user_ids:
+        _remember_profile(user_id, batch[user_id][:3])
+
+async def _user_flush_loop():
+    while True:
+        await asyncio.sleep(USER_FLUSH_INTERVAL)
+        await flush_user_activity()
 
-async def get_or_create_id(conn, table_name, column_name, value):
-    """Универсальная функция для получения ID из справочника."""
+def start_user_flusher():
+    """Запускает периодический сброс активности пользователей на текущем event loop'е."""
+    global user_flush_task
+    if user_flush_task is None:
+        user_flush_task = asyncio.create_task(_user_flush_loop())
+
+async def stop_user_flusher():
+    """Останавливает периодический сброс и записывает все, что накопилось."""
+    global user_flush_task
+    if user_flush_task is not None:
+        user_flush_task.cancel()
+        await asyncio.gather(user_flush_task, return_exceptions=True)
+        user_flush_task = None
+    await flush_user_activity()
+
+# Кэш ID справочников в памяти процесса: {'cars': {plate: id}, 'drivers': {name: id}}.
+# Строки справочников никогда не удаляются, поэтому кэш не нужно инвалидировать.
+dimension_cache = {'cars': {}, 'drivers': {}}
+
+async def resolve_dimension_ids(conn, table_name, column_name, values) -> dict:
+    """Получает ID для набора значений справочника одним set-based upsert'ом."""
     id_column = f"{table_name[:-1]}_id"
-    record_id = await conn.fetchval(f'SELECT {id_column} FROM {table_name} WHERE {column_name} = $1', value)
-    if record_id:
-        return record_id
-    return await conn.fetchval(f'INSERT INTO {table_name} ({column_name}) VALUES ($1) RETURNING {id_column}', value)
+    cache = dimension_cache[table_name]
+    missing = [v for v in set(values) if v not in cache]
+    resolved = {v: cache[v] for v in set(values) if v in cache}
+    if missing:
+        await conn.execute(f'INSERT INTO {table_name} ({column_name}) SELECT unnest($1::text[]) ON CONFLICT ({column_name}) DO NOTHING', missing)
+        records = await conn.fetch(f'SELECT {id_column}, {column_name} FROM {table_name} WHERE {column_name} = ANY($1::text[])', missing)
+        resolved.update({r[column_name]: r[id_column] for r in records})
+    return resolved
 
-async def add_trips_from_df(user_id: int, df: pd.DataFrame):
-    """Добавляет поездки, получая ID из справочников."""
-    if not pool: return
-    async with pool.acquire() as conn:
-        records_to_insert = []
-        for _, row in df.iterrows():
-            car_id = await get_or_create_id(conn, "cars", "plate_number", str(row['Гос_номер']))
-            driver_id = await get_or_create_id(conn, "drivers", "name", str(row['Водитель']))
-            try:
-                trip_date_str = str(row.get('Дата', ''))
-                trip_date = datetime.strptime(trip_date_str, '%d.%m.%y').date() if trip_date_str != 'Дата не найдена' else None
-            except (ValueError, TypeError):
-                trip_date = None
-            records_to_insert.append((user_id, car_id, driver_id, row['Источник'], trip_date, row['Маршрут'], row['Стоимость']))
-        
-        if records_to_insert:
-            await conn.executemany("""
-                INSERT INTO trips (user_id, car_id, driver_id, source_file, trip_date, route, amount)
-                VALUES ($1, $2, $3, $4, $5, $6, $7)
-            """, records_to_insert)
+@metrics.timed_db
+async def add_trips_from_df(user_id: int, df: pd.DataFrame, file_unique_id: str = None, sha256: str = None, file_name: str = None) -> int:
+    """Добавляет поездки одного файла. Возвращает число добавленных поездок (0, если файл уже был загружен)."""
+    if df.empty: return 0
+    return (await add_trip_batches(user_id, [(df, file_unique_id, sha256, file_name)]))[0]
+
+@metrics.timed_db
+async def add_trip_batches(user_id: int, batches: list, archives: list = ()) -> list:
+    """
+    Добавляет поездки нескольких файлов одной транзакцией: записи в files, справочники — пачкой,
+    поездки всех файлов — одним COPY, роллапы — одним обновлением.
+    batches - список (DataFrame, file_unique_id, sha256, file_name). Возвращает список числа добавленных
+    поездок в том же порядке (0 для файла, который уже был загружен).
+    archives - (file_unique_id, sha256, file_name) целиком загруженных архивов: они записываются в files
+    без поездок, чтобы повторно отправленный архив узнавался до скачивания и распаковки.
+    """
+    added = [0] * len(batches)
+    batches = [(i, df, *rest) for i, (df, *rest) in enumerate(batches) if not df.empty]
+    if not pool or not (batches or archives): return added
+    prepared = []
+    for i, df, file_unique_id, sha256, file_name in batches:
+        trip_dates = pd.to_datetime(df['Дата'], format='%d.%m.%y', errors='coerce')
+        # В trips сумма хранится как REAL, округляем так же, чтобы роллапы сходились с сырыми данными
+        prepared.append((i, df, file_unique_id, sha256, file_name if file_name is not None else str(df['Источник'].iloc[0]),
+                         df['Гос_номер'].astype(str), df['Водитель'].astype(str),
+                         [d.date() if pd.notna(d) else None for d in trip_dates],
+                         df['Стоимость'].astype('float32').astype('float64')))
+    months = {d.replace(day=1) for p in prepared for d in p[7] if d is not None}
+    async with acquire() as conn:
+        # DDL вне транзакции вставки: иначе блокировка trips держалась бы до конца COPY
+        await ensure_trip_partitions(conn, months)
+        async with conn.transaction():
+            for file_unique_id, sha256, file_name in archives:
+                await conn.execute("""
+                    INSERT INTO files (user_id, file_unique_id, sha256, file_name) VALUES ($1, $2, $3, $4)
+                    ON CONFLICT DO NOTHING
+                """, user_id, file_unique_id, sha256, file_name)
+            file_ids = {}
+            for i, df, file_unique_id, sha256, file_name, *_ in prepared:
+                file_id = await conn.fetchval("""
+                    INSERT INTO files (user_id, file_unique_id, sha256, file_name, trips)
+                    VALUES ($1, $2, $3, $4, $5)
+                    ON CONFLICT DO NOTHING
+                    RETURNING file_id
+                """, user_id, file_unique_id, sha256, file_name, len(df))
+                # None - такой же файл уже загружен (возможно, параллельно в другом обновлении)
+                if file_id is not None: file_ids[i] = file_id
+            prepared = [p for p in prepared if p[0] in file_ids]
+            if not prepared:
+                return added
+            car_ids = await resolve_dimension_ids(conn, "cars", "plate_number", pd.concat([p[5] for p in prepared]))
+            driver_ids = await resolve_dimension_ids(conn, "drivers", "name", pd.concat([p[6] for p in prepared]))
+            records_to_insert = []
+            for i, df, _, _, _, plates, drivers, trip_dates, amounts in prepared:
+                file_id = file_ids[i]
+                records_to_insert.extend(
+                    (user_id, car_ids[plate], driver_ids[driver], file_id, source, trip_date, route, float(amount))
+                    for plate, driver, source, trip_date, route, amount
+                    in zip(plates, drivers, df['Источник'], trip_dates, df['Маршрут'], amounts))
+                added[i] = len(df)
+            await conn.copy_records_to_table(
+                'trips', records=records_to_insert,
+                columns=['user_id', 'car_id', 'driver_id', 'file_id', 'source_file', 'trip_date', 'route', 'amount'])
+            await update_rollups(conn, user_id, pd.DataFrame(
+                [r[1:4] + (r[5], r[7]) for r in records_to_insert],
+                columns=['car_id', 'driver_id', 'file_id', 'trip_date', 'amount']))
+            await notify(conn, TRIPS_CHANNEL, user_id=user_id)
+    invalidate_user(user_id)
+    # Заполняем кэш только после коммита, чтобы не запомнить откатившиеся ID
+    dimension_cache['cars'].update(car_ids)
+    dimension_cache['drivers'].update(driver_ids)
+    return added
+
+# --- Секционирование trips по месяцам trip_date ---
+TRIPS_FOREIGN_KEYS = {
+    'user_id': 'users(user_id) ON DELETE CASCADE',
+    'car_id': 'cars(car_id) ON DELETE RESTRICT',
+    'driver_id': 'drivers(driver_id) ON DELETE RESTRICT',
+    'file_id': 'files(file_id) ON DELETE CASCADE',
+}
+# Индексы создаются на родительской таблице и наследуются каждой партицией
+TRIPS_INDEXES = {
+    'trips_user_date_idx': '(user_id, trip_date)',
+    'trips_user_car_date_idx': '(user_id, car_id, trip_date)',
+    'trips_user_driver_date_idx': '(user_id, driver_id, trip_date)',
+}
+trip_partitions = set()  # первые числа месяцев, для которых партиция уже есть
+
+def month_range(month: date) -> tuple:
+    """Полуинтервал [первое число месяца, первое число следующего)."""
+    start = month.replace(day=1)
+    return start, (start + timedelta(days=32)).replace(day=1)
+
+async def create_trips_table(conn):
+    """
+    Создает trips, секционированную по месяцам trip_date (поездки без даты - в trips_undated).
+    Старую несекционированную trips переносит в новую одной транзакцией.
+    Первичный ключ (trip_id) есть у каждой партиции, а не у родителя: ключ родителя обязан включать
+    trip_date, а она у поездок без даты NULL. trip_id берется из одной последовательности.
+    """
+    kind = await conn.fetchval("SELECT relkind::text FROM pg_class WHERE oid = to_regclass('trips')")
+    if kind != 'p':
+        async with conn.transaction():
+            if kind is None:
+                await conn.execute("CREATE SEQUENCE IF NOT EXISTS trips_trip_id_seq")
+                await conn.execute("""
+                    CREATE TABLE trips (
+                        trip_id INT NOT NULL DEFAULT nextval('trips_trip_id_seq'),
+                        user_id BIGINT,
+                        car_id INT,
+                        driver_id INT,
+                        source_file TEXT,
+                        trip_date DATE,
+                        route TEXT,
+                        amount REAL
+                    ) PARTITION BY RANGE (trip_date);
+                """)
+                await conn.execute("ALTER SEQUENCE trips_trip_id_seq OWNED BY trips.trip_id")
+                await conn.execute("CREATE TABLE trips_undated PARTITION OF trips (PRIMARY KEY (trip_id)) DEFAULT")
+                columns = ['user_id', 'car_id', 'driver_id']
+            else:
+                logging.info("Migrating trips to a month-partitioned table...")
+                await conn.execute("ALTER TABLE trips RENAME TO trips_legacy")
+                await conn.execute("CREATE TABLE trips (LIKE trips_legacy INCLUDING DEFAULTS) PARTITION BY RANGE (trip_date)")
+                sequence = await conn.fetchval("SELECT pg_get_serial_sequence('trips_legacy', 'trip_id')")
+                await conn.execute(f"ALTER SEQUENCE {sequence} OWNED BY trips.trip_id")
+                await conn.execute("CREATE TABLE trips_undated PARTITION OF trips (PRIMARY KEY (trip_id)) DEFAULT")
+                months = await conn.fetch("SELECT DISTINCT date_trunc('month', trip_date)::date AS month FROM trips_legacy WHERE trip_date IS NOT NULL")
+                await ensure_trip_partitions(conn, [r['month'] for r in months])
+                await conn.execute("INSERT INTO trips SELECT * FROM trips_legacy")
+                columns = [r['column_name'] for r in await conn.fetch(
+                    "SELECT column_name FROM information_schema.columns WHERE table_name = 'trips_legacy'")]
+                await conn.execute("DROP TABLE trips_legacy")
+            for column in columns:
+                if column in TRIPS_FOREIGN_KEYS:
+                    await conn.execute(f"ALTER TABLE trips ADD FOREIGN KEY ({column}) REFERENCES {TRIPS_FOREIGN_KEYS[column]}")
+    for index, definition in TRIPS_INDEXES.items():
+        await conn.execute(f"CREATE INDEX IF NOT EXISTS {index} ON trips {definition}")
+    partitions = await conn.fetch("""
+        SELECT c.relname, EXISTS (SELECT 1 FROM pg_constraint WHERE conrelid = c.oid AND contype = 'p') AS has_key
+        FROM pg_inherits AS i JOIN pg_class AS c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'trips'::regclass
+    """)
+    # Партиции, созданные до появления ключей
+    for r in partitions:
+        if not r['has_key']:
+            await conn.execute(f"ALTER TABLE {r['relname']} ADD PRIMARY KEY (trip_id)")
+    trip_partitions.update(datetime.strptime(r['relname'], 'trips_%Y_%m').date() for r in partitions if r['relname'] != 'trips_undated')
+
+async def ensure_trip_partitions(conn, months):
+    """Создает недостающие помесячные партиции trips."""
+    for month in sorted(set(months) - trip_partitions):
+        start, end = month_range(month)
+        try:
+            await conn.execute(f"CREATE TABLE IF NOT EXISTS trips_{start:%Y_%m} PARTITION OF trips (PRIMARY KEY (trip_id)) FOR VALUES FROM ('{start}') TO ('{end}')")
+        except (asyncpg.DuplicateTableError, asyncpg.UniqueViolationError):
+            pass  # партицию одновременно создала другая реплика
+        trip_partitions.add(start)
+
+TRIPS_COLUMNS = ["Источник", "Дата", "Маршрут", "Стоимость", "Гос_номер", "Водитель"]
+TRIPS_QUERY = """
+    SELECT
+        t.source_file AS "Источник",
+        t.trip_date AS "Дата",
+        t.route AS "Маршрут",
+        t.amount AS "Стоимость",
+        c.plate_number AS "Гос_номер",
+        d.name AS "Водитель"
+    FROM trips AS t
+    LEFT JOIN cars AS c ON t.car_id = c.car_id
+    LEFT JOIN drivers AS d ON t.driver_id = d.driver_id
+    WHERE t.user_id = $1 {filter}
+    ORDER BY t.trip_date, t.trip_id
+"""
+# Типы колонок DataFrame'а поездок. Повторяющиеся строки - категории, даты - datetime64,
+# сумма - float32, как REAL в trips. Все DataFrame'ы поездок из БД получают эти типы (trips_frame, fetch_trips_frame).
+TRIPS_DTYPES = {
+    'Источник': 'category',
+    'Дата': 'datetime64[ns]',
+    'Маршрут': 'category',
+    'Стоимость': 'float32',
+    'Гос_номер': 'category',
+    'Водитель': 'category',
+}
+
+def trips_frame(records) -> pd.DataFrame:
+    """DataFrame поездок из записей TRIPS_QUERY с типами TRIPS_DTYPES (пустой - с теми же колонками)."""
+    columns = list(zip(*records)) if records else [()] * len(TRIPS_COLUMNS)
+    return pd.DataFrame({name: pd.Series(list(values), dtype=TRIPS_DTYPES[name]) for name, values in zip(TRIPS_COLUMNS, columns)})
+
+async def fetch_trips_frame(conn, conditions: str = "", args: list = ()) -> pd.DataFrame:
+    """
+    Выгружает TRIPS_QUERY через COPY ... TO STDOUT в CSV и разбирает его read_csv'ом сразу
+    по колонкам, без asyncpg Record на каждую строку. conditions/args - из trips_filter.
+    """
+    chunks = []
+    async def sink(chunk):
+        chunks.append(chunk)
+    await conn.copy_from_query(TRIPS_QUERY.format(filter=conditions), *args, output=sink, format='csv', null='\\N')
+    if not chunks:
+        return trips_frame([])
+    # NULL выгружается как \N, чтобы не путать его с пустой строкой ""; прочие "NA"/"null" - обычные значения (например, фамилия)
+    df = pd.read_csv(io.BytesIO(b"".join(chunks)), header=None, names=TRIPS_COLUMNS, keep_default_na=False, na_values=['\\N'],
+                     dtype={k: v for k, v in TRIPS_DTYPES.items() if not v.startswith('datetime')}, parse_dates=['Дата'])
+    return df.astype(TRIPS_DTYPES)
+
+# Фильтры для выборки поездок по одной машине/водителю ({} - номер параметра)
+TRIPS_FILTERS = {'car': 'AND c.plate_number = ${}', 'driver': 'AND d.name = ${}'}
 
+def trips_filter(group_by: str = None, name: str = None, date_from: date = None, date_to: date = None, first_param: int = 2) -> tuple:
+    """
+    Условия для trips AS t (дописываются после t.user_id = $1) и их параметры.
+    Период - полуинтервал [date_from, date_to); по нему Postgres отсекает лишние партиции.
+    """
+    conditions, args = [], []
+    def add(condition, value):
+        args.append(value)
+        conditions.append(condition.format(first_param + len(args) - 1))
+    if group_by: add(TRIPS_FILTERS[group_by], name)
+    if date_from is not None: add("AND t.trip_date >= ${}", date_from)
+    if date_to is not None: add("AND t.trip_date < ${}", date_to)
+    return " ".join(conditions), args
+
+@metrics.timed_db
 async def get_all_trips_as_df(user_id: int) -> pd.DataFrame:
-    """Получает все данные с именами из справочников с помощью JOIN."""
+    """
+    Получает все данные с именами из справочников с помощью JOIN.
+    Результат кэшируется до следующего изменения данных пользователя, поэтому
+    возвращаемый DataFrame общий — изменять его на месте нельзя.
+    """
+    if not pool: return pd.DataFrame()
+    version = get_data_version(user_id)
+    entry = trips_cache.get(user_id)
+    if entry and entry[0] == version:
+        trips_cache.move_to_end(user_id)
+        trips_cache_stats['hits'] += 1
+        return entry[1]
+    trips_cache_stats['misses'] += 1
+    async with acquire() as conn:
+        df = await fetch_trips_frame(conn, "", [user_id])
+    metrics.rows_fetched.inc(len(df), 'get_all_trips_as_df')
+    # Если пока шел запрос данные успели измениться, результат уже устарел
+    if version == get_data_version(user_id):
+        _cache_put(user_id, version, df)
+    return df
+
+@metrics.timed_db
+async def get_trips_df(user_id: int, group_by: str = None, name: str = None, date_from: date = None, date_to: date = None) -> pd.DataFrame:
+    """Поездки с фильтрами по машине/водителю и периоду, отобранные на стороне Postgres. Не кэшируется."""
     if not pool: return pd.DataFrame()
-    query = """
-        SELECT
-            t.source_file AS "Источник",
-            TO_CHAR(t.trip_date, 'DD.MM.YY') AS "Дата",
-            t.route AS "Маршрут",
-            t.amount AS "Стоимость",
-            c.plate_number AS "Гос_номер",
-            d.name AS "Водитель"
+    conditions, args = trips_filter(group_by, name, date_from, date_to)
+    async with acquire() as conn:
+        df = await fetch_trips_frame(conn, conditions, [user_id, *args])
+    metrics.rows_fetched.inc(len(df), 'get_trips_df')
+    return df
+
+async def iter_trips(user_id: int, group_by: str = None, name: str = None, date_from: date = None, date_to: date = None, prefetch: int = 1000):
+    """
+    Отдает поездки пользователя по одной через серверный курсор, не загружая всю историю в память.
+    group_by/name ('car' или 'driver' и точное имя) ограничивают выборку одной машиной/водителем,
+    date_from/date_to - периодом.
+    """
+    if not pool: return
+    conditions, args = trips_filter(group_by, name, date_from, date_to)
+    query = TRIPS_QUERY.format(filter=conditions)
+    args = [user_id, *args]
+    async with acquire() as conn:
+        async with conn.transaction():
+            row_count = 0
+            try:
+                async for record in conn.cursor(query, *args, prefetch=prefetch):
+                    row_count += 1
+                    yield record
+            finally:
+                metrics.rows_fetched.inc(row_count, 'iter_trips')
+
+# --- Агрегаты на стороне Postgres ---
+# За все время агрегаты берутся из роллапов, за период - считаются по партициям trips
+GROUP_COLUMNS = {
+    'car': ('user_car_rollups AS r JOIN cars AS g ON r.car_id = g.car_id', 'g.plate_number'),
+    'driver': ('user_driver_rollups AS r JOIN drivers AS g ON r.driver_id = g.driver_id', 'g.name'),
+}
+# (справочник, ключ в trips, колонка с именем)
+TRIP_DIMENSIONS = {'car': ('cars', 'car_id', 'plate_number'), 'driver': ('drivers', 'driver_id', 'name')}
+
+@metrics.timed_db
+async def get_user_stats(user_id: int, date_from: date = None, date_to: date = None) -> dict:
+    """Возвращает файлы, поездки, сумму и число уникальных машин/водителей пользователя (за период, если задан)."""
+    empty = {'files': 0, 'trips': 0, 'total': 0.0, 'cars': 0, 'drivers': 0}
+    if not pool: return empty
+    async with acquire() as conn:
+        if date_from is None and date_to is None:
+            record = await conn.fetchrow("SELECT files, trips, total, cars, drivers FROM user_rollups WHERE user_id = $1", user_id)
+        else:
+            conditions, args = trips_filter(date_from=date_from, date_to=date_to)
+            record = await conn.fetchrow(f"""
+                SELECT COUNT(DISTINCT t.file_id) AS files, COUNT(*) AS trips, COALESCE(SUM(t.amount::float8), 0) AS total,
+                       COUNT(DISTINCT t.car_id) AS cars, COUNT(DISTINCT t.driver_id) AS drivers
+                FROM trips AS t
+                WHERE t.user_id = $1 {conditions}
+            """, user_id, *args)
+    return dict(record) if record else empty
+
+def _totals_query(user_id: int, group_by: str, date_from: date = None, date_to: date = None) -> tuple:
+    """Запрос (item, total) по машинам/водителям: из роллапа или, если задан период, по trips."""
+    if date_from is None and date_to is None:
+        source, column = GROUP_COLUMNS[group_by]
+        return f"SELECT {column} AS item, r.total FROM {source} WHERE r.user_id = $1", [user_id]
+    table, key, column = TRIP_DIMENSIONS[group_by]
+    conditions, args = trips_filter(date_from=date_from, date_to=date_to)
+    return f"""
+        SELECT g.{column} AS item, SUM(t.amount::float8) AS total
         FROM trips AS t
-        LEFT JOIN cars AS c ON t.car_id = c.car_id
-        LEFT JOIN drivers AS d ON t.driver_id = d.driver_id
-        WHERE t.user_id = $1
-        ORDER BY t.trip_date, t.trip_id;
-    """
-    async with pool.acquire() as conn:
-        records = await conn.fetch(query, user_id)
-        if not records:
-            return pd.DataFrame()
-        # Создаем DataFrame из записей, используя ключи как имена колонок
-        return pd.DataFrame(records, columns=records[0].keys())
-
-async def get_processed_files(user_id: int) -> set:
-    """Получает множество имен уже обработанных файлов."""
-    if not pool: return set()
-    async with pool.acquire() as conn:
-        records = await conn.fetch("SELECT DISTINCT source_file FROM trips WHERE user_id = $1", user_id)
-        return {record['source_file'] for record in records}
+        JOIN {table} AS g ON t.{key} = g.{key}
+        WHERE t.user_id = $1 {conditions}
+        GROUP BY item
+    """, [user_id, *args]
+
+@metrics.timed_db
+async def get_totals_by(user_id: int, group_by: str, limit: int = None, date_from: date = None, date_to: date = None) -> list:
+    """Возвращает [(машина или водитель, сумма), ...] по убыванию суммы; group_by - 'car' или 'driver'."""
+    if not pool: return []
+    base, args = _totals_query(user_id, group_by, date_from, date_to)
+    query = f"SELECT s.item, s.total FROM ({base}) AS s ORDER BY s.total DESC, s.item"
+    if limit is not None:
+        query += f" LIMIT ${len(args) + 1}"
+        args.append(limit)
+    async with acquire() as conn:
+        records = await conn.fetch(query, *args)
+    metrics.rows_fetched.inc(len(records), 'get_totals_by')
+    return [(r['item'], r['total']) for r in records]
+
+@metrics.timed_db
+async def get_totals_page(user_id: int, group_by: str, limit: int, after: tuple = None, before: tuple = None,
+                          date_from: date = None, date_to: date = None) -> tuple:
+    """
+    Страница get_totals_by с keyset-пагинацией: after/before - строка (имя, сумма), после которой
+    или до которой нужна страница (последняя/первая строка уже показанной). Возвращает (строки, есть ли еще строки в ту же сторону).
+    """
+    if not pool: return [], False
+    base, args = _totals_query(user_id, group_by, date_from, date_to)
+    n = len(args)
+    if after is not None:
+        where, order = f"WHERE (-s.total, s.item) > (-${n + 1}::float8, ${n + 2})", "s.total DESC, s.item"
+        args.extend((after[1], after[0]))
+    elif before is not None:
+        where, order = f"WHERE (-s.total, s.item) < (-${n + 1}::float8, ${n + 2})", "s.total, s.item DESC"
+        args.extend((before[1], before[0]))
+    else:
+        where, order = "", "s.total DESC, s.item"
+    query = f"SELECT s.item, s.total FROM ({base}) AS s {where} ORDER BY {order} LIMIT ${len(args) + 1}"
+    async with acquire() as conn:
+        records = await conn.fetch(query, *args, limit + 1)
+    metrics.rows_fetched.inc(len(records), 'get_totals_page')
+    rows = [(r['item'], r['total']) for r in records[:limit]]
+    if before is not None:
+        rows.reverse()
+    return rows, len(records) > limit
+
+# --- Поиск машин и водителей ---
+SEARCH_LIMIT = 8
+SEARCH_INDEX_MAX_ENTRIES = int(os.getenv("SEARCH_INDEX_MAX_ENTRIES", 512))
+search_index = OrderedDict()  # (user_id, group_by) -> (версия данных, [(имя в нижнем регистре, имя), ...] отсортировано), порядок = LRU
 
+@metrics.timed_db
+async def get_item_names(user_id: int, group_by: str) -> list:
+    """Все машины или водители пользователя (из роллапа, по индексу user_id)."""
+    if not pool: return []
+    source, column = GROUP_COLUMNS[group_by]
+    async with acquire() as conn:
+        records = await conn.fetch(f"SELECT {column} AS item FROM {source} WHERE r.user_id = $1", user_id)
+    metrics.rows_fetched.inc(len(records), 'get_item_names')
+    return [r['item'] for r in records]
+
+@metrics.timed_db
+async def search_items(user_id: int, group_by: str, text: str, limit: int = SEARCH_LIMIT) -> list:
+    """
+    Ищет машины/водителей пользователя по введенному тексту без учета регистра.
+    Сначала совпадения по префиксу, затем по подстроке. Индекс строится в памяти одним
+    запросом и живет до следующего изменения данных пользователя.
+    """
+    key = (user_id, group_by)
+    version = get_data_version(user_id)
+    entry = search_index.get(key)
+    if entry and entry[0] == version:
+        search_index.move_to_end(key)
+    else:
+        names = await get_item_names(user_id, group_by)
+        entry = (version, sorted((str(name).lower(), name) for name in names))
+        search_index[key] = entry
+        search_index.move_to_end(key)
+        while len(search_index) > SEARCH_INDEX_MAX_ENTRIES:
+            search_index.popitem(last=False)
+    index = entry[1]
+    needle = text.strip().lower()
+    if not needle: return []
+    matches = []
+    position = bisect.bisect_left(index, (needle,))
+    while position < len(index) and index[position][0].startswith(needle) and len(matches) < limit:
+        matches.append(index[position][1])
+        position += 1
+    if len(matches) < limit:
+        seen = set(matches)
+        for lowered, name in index:
+            if needle in lowered and name not in seen:
+                matches.append(name)
+                if len(matches) >= limit: break
+    return matches
+
+@metrics.timed_db
+async def get_item_stats(user_id: int, group_by: str, name: str, date_from: date = None, date_to: date = None) -> dict:
+    """Поездки и сумма по одной машине/водителю плюс связанные водители/машины (за период, если задан)."""
+    empty = {'trips': 0, 'total': 0.0, 'related': []}
+    if not pool: return empty
+    source, column = GROUP_COLUMNS[group_by]
+    _, key, _ = TRIP_DIMENSIONS[group_by]
+    other_table, other_key, other_column = TRIP_DIMENSIONS['driver' if group_by == 'car' else 'car']
+    conditions, period_args = trips_filter(date_from=date_from, date_to=date_to, first_param=3)
+    async with acquire() as conn:
+        record = await conn.fetchrow(f"SELECT r.{key} AS id, r.trips, r.total FROM {source} WHERE r.user_id = $1 AND {column} = $2", user_id, name)
+        if not record:
+            return empty
+        if conditions:
+            record = await conn.fetchrow(f"""
+                SELECT $2::int AS id, COUNT(*) AS trips, COALESCE(SUM(t.amount::float8), 0) AS total
+                FROM trips AS t
+                WHERE t.user_id = $1 AND t.{key} = $2 {conditions}
+            """, user_id, record['id'], *period_args)
+            if not record['trips']:
+                return empty
+        related = await conn.fetch(f"""
+            SELECT DISTINCT o.{other_column} AS item
+            FROM trips AS t
+            JOIN {other_table} AS o ON t.{other_key} = o.{other_key}
+            WHERE t.user_id = $1 AND t.{key} = $2 {conditions}
+            ORDER BY item
+        """, user_id, record['id'], *period_args)
+    return {'trips': record['trips'], 'total': record['total'], 'related': [r['item'] for r in related]}
+
+@metrics.timed_db
+async def get_available_months(user_id: int) -> list:
+    """Месяцы с поездками пользователя из помесячного роллапа: [(первое число месяца, поездки, сумма), ...], новые первыми."""
+    if not pool: return []
+    async with acquire() as conn:
+        records = await conn.fetch("SELECT month, trips, total FROM user_month_rollups WHERE user_id = $1 ORDER BY month DESC", user_id)
+    return [(r['month'], r['trips'], r['total']) for r in records]
+
+# --- Загруженные файлы ---
+async def create_files_table(conn) -> bool:
+    """
+    Создает таблицу files и привязывает к ней поездки, загруженные до ее появления.
+    Возвращает True, если такие поездки были (тогда роллапы нужно пересобрать).
+    """
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS files (
+            file_id SERIAL PRIMARY KEY,
+            user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+            file_unique_id TEXT,
+            sha256 TEXT,
+            file_name TEXT,
+            trips INT NOT NULL DEFAULT 0,
+            uploaded_at TIMESTAMPTZ DEFAULT NOW(),
+            UNIQUE (user_id, file_unique_id),
+            UNIQUE (user_id, sha256)
+        );
+    """)
+    await conn.execute("ALTER TABLE trips ADD COLUMN IF NOT EXISTS file_id INT REFERENCES files(file_id) ON DELETE CASCADE;")
+    if await conn.fetchval("SELECT EXISTS (SELECT 1 FROM trips WHERE file_id IS NULL)"):
+        # Старые поездки: по одной записи в files на каждое имя файла, без хэшей
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO files (user_id, file_name, trips)
+                SELECT user_id, source_file, COUNT(*) FROM trips WHERE file_id IS NULL GROUP BY user_id, source_file
+            """)
+            await conn.execute("""
+                UPDATE trips SET file_id = f.file_id
+                FROM files AS f
+                WHERE trips.file_id IS NULL AND f.user_id = trips.user_id
+                  AND f.file_name IS NOT DISTINCT FROM trips.source_file AND f.sha256 IS NULL
+            """)
+        return True
+    return False
+
+@metrics.timed_db
+async def find_processed_files(user_id: int, file_unique_ids: list = (), sha256s: list = ()) -> dict:
+    """Одним запросом ищет ранее загруженные файлы по file_unique_id и SHA-256. Возвращает {id или хэш: имя файла}."""
+    if not pool: return {}
+    async with acquire() as conn:
+        records = await conn.fetch("""
+            SELECT file_unique_id, sha256, file_name FROM files
+            WHERE user_id = $1 AND (file_unique_id = ANY($2::text[]) OR sha256 = ANY($3::text[]))
+        """, user_id, list(file_unique_ids), list(sha256s))
+    found = {}
+    for record in records:
+        for key in (record['file_unique_id'], record['sha256']):
+            if key is not None: found[key] = record['file_name']
+    return found
+
+@metrics.timed_db
 async def clear_user_data(user_id: int):
     """Удаляет только поездки пользователя, не трогая справочники."""
     if not pool: return
-    async with pool.acquire() as conn:
-        await conn.execute("DELETE FROM trips WHERE user_id = $1", user_id)
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("DELETE FROM trips WHERE user_id = $1", user_id)
+            await conn.execute("DELETE FROM files WHERE user_id = $1", user_id)
+            await delete_rollups(conn, user_id)
+            await notify(conn, TRIPS_CHANNEL, user_id=user_id)
+    invalidate_user(user_id)
+
+# --- Синхронизация реплик через LISTEN/NOTIFY ---
+# Каждая реплика держит свои кэши; об изменениях в БД остальные узнают по уведомлениям
+REPLICA_ID = os.getenv("REPLICA_ID") or uuid.uuid4().hex
+TRIPS_CHANNEL = 'trips_changed'
+STATE_CHANNEL = 'bot_state_changed'
+LISTEN_RETRY_DELAY = 5
+
+subscribers = {TRIPS_CHANNEL: [], STATE_CHANNEL: []}  # канал -> [callback(payload)], payload None - уведомления могли потеряться
+listener_task = None
+
+def subscribe(channel: str, callback):
+    subscribers[channel].append(callback)
+
+async def notify(conn, channel: str, **payload):
+    """Шлет уведомление другим репликам. Внутри транзакции оно уходит только после коммита."""
+    await conn.execute("SELECT pg_notify($1, $2)", channel, json.dumps({'replica': REPLICA_ID, **payload}))
+
+def _dispatch(channel: str, payload):
+    for callback in subscribers[channel]:
+        try: callback(payload)
+        except Exception as e: logging.error(f"Notification handler for '{channel}' failed: {e}")
+
+def _on_notification(conn, pid, channel, payload):
+    message = json.loads(payload)
+    if message.get('replica') == REPLICA_ID: return  # свои изменения уже учтены
+    _dispatch(channel, message)
+
+async def _listen_loop():
+    while True:
+        conn = None
+        try:
+            conn = await asyncpg.connect(dsn=os.getenv("DATABASE_URL"))
+            closed = asyncio.Event()
+            conn.add_termination_listener(lambda _: closed.set())
+            for channel in subscribers:
+                await conn.add_listener(channel, _on_notification)
+            # Пока слушателя не было, уведомления могли потеряться - сбрасываем кэши целиком
+            for channel in subscribers:
+                _dispatch(channel, None)
+            await closed.wait()
+            logging.warning("Notification listener connection closed, reconnecting.")
+        except asyncio.CancelledError:
+            raise
+        except Exception as e:
+            logging.error(f"Notification listener failed: {e}")
+        finally:
+            if conn is not None and not conn.is_closed():
+                conn.terminate()
+        await asyncio.sleep(LISTEN_RETRY_DELAY)
+
+def start_listener():
+    """Запускает прием уведомлений от других реплик на текущем event loop'е."""
+    global listener_task
+    if listener_task is None:
+        listener_task = asyncio.create_task(_listen_loop())
+
+async def stop_listener():
+    global listener_task
+    if listener_task is not None:
+        listener_task.cancel()
+        await asyncio.gather(listener_task, return_exceptions=True)
+        listener_task = None
+
+def _on_trips_changed(payload):
+    if payload is None:
+        for user_id in set(data_versions) | set(trips_cache) | {key[0] for key in search_index}:
+            invalidate_user(user_id)
+    else:
+        invalidate_user(payload['user_id'])
+subscribe(TRIPS_CHANNEL, _on_trips_changed)
+
+# --- Состояние диалогов и user_data (см. persistence.py) ---
+async def create_state_tables(conn):
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_user_data (
+            user_id BIGINT PRIMARY KEY,
+            data JSONB NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT NOW()
+        );
+    """)
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS bot_conversations (
+            name TEXT,
+            key TEXT,
+            state JSONB NOT NULL,
+            updated_at TIMESTAMPTZ DEFAULT NOW(),
+            PRIMARY KEY (name, key)
+        );
+    """)
+
+@metrics.timed_db
+async def load_user_data(user_id: int) -> dict:
+    if not pool: return {}
+    async with acquire() as conn:
+        data = await conn.fetchval("SELECT data FROM bot_user_data WHERE user_id = $1", user_id)
+    return json.loads(data) if data else {}
+
+@metrics.timed_db
+async def save_user_data(user_id: int, data: dict):
+    if not pool: return
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("""
+                INSERT INTO bot_user_data (user_id, data) VALUES ($1, $2::jsonb)
+                ON CONFLICT (user_id) DO UPDATE SET data = EXCLUDED.data, updated_at = NOW()
+            """, user_id, json.dumps(data, ensure_ascii=False))
+            await notify(conn, STATE_CHANNEL, user_id=user_id)
+
+@metrics.timed_db
+async def delete_user_data(user_id: int):
+    if not pool: return
+    async with acquire() as conn:
+        async with conn.transaction():
+            await conn.execute("DELETE FROM bot_user_data WHERE user_id = $1", user_id)
+            await notify(conn, STATE_CHANNEL, user_id=user_id)
+
+@metrics.timed_db
+async def load_conversation_state(name: str, key: tuple):
+    """Состояние диалога name для ключа key или None, если диалога нет."""
+    if not pool: return None
+    async with acquire() as conn:
+        state = await conn.fetchval("SELECT state FROM bot_conversations WHERE name = $1 AND key = $2", name, json.dumps(list(key)))
+    return json.loads(state) if state is not None else None
+
+@metrics.timed_db
+async def load_conversations(name: str) -> dict:
+    """Все сохраненные состояния диалога name: {ключ: состояние}."""
+    if not pool: return {}
+    async with acquire() as conn:
+        records = await conn.fetch("SELECT key, state FROM bot_conversations WHERE name = $1", name)
+    return {tuple(json.loads(r['key'])): json.loads(r['state']) for r in records}
+
+@metrics.timed_db
+async def save_conversation_state(name: str, key: tuple, state):
+    """Сохраняет состояние диалога; None - диалог завершен, запись удаляется."""
+    if not pool: return
+    key_text = json.dumps(list(key))
+    async with acquire() as conn:
+        async with conn.transaction():
+            if state is None:
+                await conn.execute("DELETE FROM bot_conversations WHERE name = $1 AND key = $2", name, key_text)
+            else:
+                await conn.execute("""
+                    INSERT INTO bot_conversations (name, key, state) VALUES ($1, $2, $3::jsonb)
+                    ON CONFLICT (name, key) DO UPDATE SET state = EXCLUDED.state, updated_at = NOW()
+                """, name, key_text, json.dumps(state))
+            await notify(conn, STATE_CHANNEL, conversation=name, key=list(key))
+
+# --- Роллапы: агрегаты, которые обновляются вместе с trips ---
+# (ключевая колонка, тип, выражение из trips) для каждой таблицы детализации
+ROLLUP_DIMENSIONS = {
+    'user_car_rollups': ('car_id', 'INT', 'car_id'),
+    'user_driver_rollups': ('driver_id', 'INT', 'driver_id'),
+    'user_file_rollups': ('file_id', 'INT', 'file_id'),
+    'user_month_rollups': ('month', 'DATE', "date_trunc('month', trip_date)::date"),
+}
+# Сколько уникальных ключей каждой детализации хранится в user_rollups
+ROLLUP_COUNTERS = {'user_car_rollups': 'cars', 'user_driver_rollups': 'drivers', 'user_file_rollups': 'files'}
+
+async def create_rollup_tables(conn) -> bool:
+    """Создает таблицы роллапов; возвращает True, если их нужно пересобрать (их не было или сменился ключ)."""
+    rebuild = not await conn.fetchval("SELECT to_regclass('user_rollups') IS NOT NULL")
+    await conn.execute("""
+        CREATE TABLE IF NOT EXISTS user_rollups (
+            user_id BIGINT PRIMARY KEY REFERENCES users(user_id) ON DELETE CASCADE,
+            trips BIGINT NOT NULL DEFAULT 0,
+            total DOUBLE PRECISION NOT NULL DEFAULT 0,
+            files INT NOT NULL DEFAULT 0,
+            cars INT NOT NULL DEFAULT 0,
+            drivers INT NOT NULL DEFAULT 0
+        );
+    """)
+    for table, (key, key_type, _) in ROLLUP_DIMENSIONS.items():
+        # Таблица со старым ключом (user_file_rollups по source_file, до появления files) пересоздается
+        stale = await conn.fetchval("""
+            SELECT to_regclass($1) IS NOT NULL AND NOT EXISTS (
+                SELECT 1 FROM information_schema.columns
+                WHERE table_schema = current_schema() AND table_name = $1 AND column_name = $2)
+        """, table, key)
+        if stale:
+            logging.info(f"Rollup table {table} has an outdated key, rebuilding it...")
+            await conn.execute(f"DROP TABLE {table}")
+            rebuild = True
+        await conn.execute(f"""
+            CREATE TABLE IF NOT EXISTS {table} (
+                user_id BIGINT REFERENCES users(user_id) ON DELETE CASCADE,
+                {key} {key_type} NOT NULL,
+                trips BIGINT NOT NULL DEFAULT 0,
+                total DOUBLE PRECISION NOT NULL DEFAULT 0,
+                PRIMARY KEY (user_id, {key})
+            );
+        """)
+    return rebuild
+
+async def update_rollups(conn, user_id: int, new_trips: pd.DataFrame):
+    """
+    Прибавляет новые поездки к роллапам. Вызывается в той же транзакции, что и вставка в trips.
+    new_trips - DataFrame с колонками car_id, driver_id, file_id, trip_date, amount.
+    """
+    new_trips = new_trips.assign(month=pd.to_datetime(new_trips['trip_date']).dt.to_period('M').dt.start_time.dt.date)
+    new_keys = {}
+    for table, (key, key_type, _) in ROLLUP_DIMENSIONS.items():
+        # Поездки без даты в помесячный роллап не попадают
+        grouped = new_trips.dropna(subset=[key]).groupby(key)['amount'].agg(['size', 'sum'])
+        if grouped.empty: continue
+        records = await conn.fetch(f"""
+            INSERT INTO {table} (user_id, {key}, trips, total)
+            SELECT $1, * FROM unnest($2::{key_type}[], $3::bigint[], $4::float8[])
+            ON CONFLICT (user_id, {key}) DO UPDATE SET
+                trips = {table}.trips + EXCLUDED.trips,
+                total = {table}.total + EXCLUDED.total
+            RETURNING (xmax = 0) AS inserted
+        """, user_id, grouped.index.tolist(), [int(n) for n in grouped['size']], [float(t) for t in grouped['sum']])
+        new_keys[table] = sum(r['inserted'] for r in records)
+    counters = {column: new_keys.get(table, 0) for table, column in ROLLUP_COUNTERS.items()}
+    await conn.execute("""
+        INSERT INTO user_rollups (user_id, trips, total, files, cars, drivers)
+        VALUES ($1, $2, $3, $4, $5, $6)
+        ON CONFLICT (user_id) DO UPDATE SET
+            trips = user_rollups.trips + EXCLUDED.trips,
+            total = user_rollups.total + EXCLUDED.total,
+            files = user_rollups.files + EXCLUDED.files,
+            cars = user_rollups.cars + EXCLUDED.cars,
+            drivers = user_rollups.drivers + EXCLUDED.drivers
+    """, user_id, len(new_trips), float(new_trips['amount'].sum()), counters['files'], counters['cars'], counters['drivers'])
+
+async def delete_rollups(conn, user_id: int = None):
+    """Удаляет роллапы пользователя (или всех пользователей, если user_id не задан)."""
+    for table in ['user_rollups', *ROLLUP_DIMENSIONS]:
+        if user_id is None:
+            await conn.execute(f"DELETE FROM {table}")
+        else:
+            await conn.execute(f"DELETE FROM {table} WHERE user_id = $1", user_id)
+
+async def rebuild_rollups(conn, user_id: int = None):
+    """Пересчитывает роллапы из сырых trips для одного или всех пользователей."""
+    user_filter = "WHERE user_id = $1" if user_id is not None else ""
+    args = [user_id] if user_id is not None else []
+    async with conn.transaction():
+        await delete_rollups(conn, user_id)
+        for table, (key, _, expression) in ROLLUP_DIMENSIONS.items():
+            await conn.execute(f"""
+                INSERT INTO {table} (user_id, {key}, trips, total)
+                SELECT user_id, {expression}, COUNT(*), SUM(amount::float8)
+                FROM trips
+                {user_filter}{' AND' if user_filter else 'WHERE'} {expression} IS NOT NULL
+                GROUP BY user_id, {expression}
+            """, *args)
+        await conn.execute(f"""
+            INSERT INTO user_rollups (user_id, trips, total, files, cars, drivers)
+            SELECT user_id, COUNT(*), SUM(amount::float8),
+                   COUNT(DISTINCT file_id), COUNT(DISTINCT car_id), COUNT(DISTINCT driver_id)
+            FROM trips
+            {user_filter}
+            GROUP BY user_id
+        """, *args)
+
+@metrics.timed_db
+async def check_rollups(user_id: int) -> bool:
+    """Сверяет все роллапы пользователя (итог и каждую детализацию) с агрегатами по сырым trips."""
+    if not pool: return True
+    async with acquire() as conn:
+        stored = await conn.fetchrow("SELECT files, trips, total, cars, drivers FROM user_rollups WHERE user_id = $1", user_id)
+        actual = await conn.fetchrow("""
+            SELECT COUNT(DISTINCT file_id) AS files, COUNT(*) AS trips, COALESCE(SUM(amount::float8), 0) AS total,
+                   COUNT(DISTINCT car_id) AS cars, COUNT(DISTINCT driver_id) AS drivers
+            FROM trips
+            WHERE user_id = $1
+        """, user_id)
+        if stored is None:
+            if actual['trips'] != 0: return False
+        elif not (all(stored[k] == actual[k] for k in ('files', 'trips', 'cars', 'drivers'))
+                  and abs(stored['total'] - actual['total']) < 0.01):
+            return False
+        for table, (key, _, expression) in ROLLUP_DIMENSIONS.items():
+            # Строка, которой нет с одной из сторон, или расхождение в количестве/сумме
+            mismatch = await conn.fetchval(f"""
+                SELECT EXISTS (
+                    SELECT 1
+                    FROM (SELECT {key}, trips, total FROM {table} WHERE user_id = $1) stored
+                    FULL JOIN (
+                        SELECT {expression} AS {key}, COUNT(*) AS trips, SUM(amount::float8) AS total
+                        FROM trips
+                        WHERE user_id = $1 AND {expression} IS NOT NULL
+                        GROUP BY 1
+                    ) actual USING ({key})
+                    WHERE stored.trips IS NULL OR actual.trips IS NULL
+                       OR stored.trips <> actual.trips OR abs(stored.total - actual.total) >= 0.01
+                )
+            """, user_id)
+            if mismatch:
+                logging.warning(f"Rollup table {table} differs from trips for user {user_id}.")
+                return False
+    return True
+
+@metrics.timed_db
+async def repair_rollups(user_id: int) -> bool:
+    """Проверяет роллапы пользователя и пересобирает их при расхождении. Возвращает True, если был ремонт."""
+    if not pool or await check_rollups(user_id): return False
+    logging.warning(f"Rollups for user {user_id} are inconsistent, rebuilding.")
+    async with acquire() as conn:
+        await rebuild_rollups(conn, user_id)
+    return True
+
+if __name__ == '__main__':
+    # python db.py - полная пересборка роллапов для всех пользователей
+    async def _rebuild_all():
+        if not await init_db(): return
+        async with acquire() as conn:
+            await rebuild_rollups(conn)
+        logging.info("Rollups rebuilt for all users.")
+    logging.basicConfig(level=logging.INFO)
+    asyncio.run(_rebuild_all())
@@ -0,0 +1,67 @@
+# dispatch.py - параллельная обработка обновлений разных пользователей
+
+import os
+import sys
+import asyncio
+from telegram import Update
+from telegram.ext import BaseUpdateProcessor
+
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES", 32))
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """
+    Обрабатывает обновления разных пользователей параллельно, а обновления одного
+    пользователя - строго по очереди (на этом держатся ConversationHandler и проверка
+    дублей в handle_document).
+
+    Общий лимит max_concurrent берется уже после очереди пользователя: иначе пачка
+    сообщений от одного пользователя заняла бы все слоты, ожидая сама себя.
+    """
+    def __init__(self, max_concurrent: int = MAX_CONCURRENT_UPDATES):
+        # Семафор базового класса не ограничивает: ожидающие своей очереди обновления не должны занимать слоты
+        super().__init__(sys.maxsize)
+        self.max_concurrent = max_concurrent
+        self.slots = None
+        self.running = 0  # обновления, уже получившие слот
+        self.user_locks = {}  # ключ пользователя -> [asyncio.Lock, число обновлений в работе и в очереди]
+
+    async def initialize(self):
+        self.slots = asyncio.Semaphore(self.max_concurrent)
+
+    async def shutdown(self):
+        self.user_locks.clear()
+
+    @staticmethod
+    def _user_key(update):
+        if isinstance(update, Update):
+            if update.effective_user: return ('user', update.effective_user.id)
+            if update.effective_chat: return ('chat', update.effective_chat.id)
+        return None
+
+    @property
+    def in_progress(self) -> int:
+        """Сколько обновлений сейчас выполняется (без ожидающих в очередях пользователей)."""
+        return self.running
+
+    async def _run(self, coroutine):
+        async with self.slots:
+            self.running += 1
+            try:
+                await coroutine
+            finally:
+                self.running -= 1
+
+    async def do_process_update(self, update, coroutine):
+        key = self._user_key(update)
+        if key is None:
+            await self._run(coroutine)
+            return
+        entry = self.user_locks.setdefault(key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                await self._run(coroutine)
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self.user_locks.pop(key, None)
@@ -0,0 +1,47 @@
+# export.py - потоковая выгрузка поездок в Excel прямо из курсора БД
+
+import os
+import tempfile
+import xlsxwriter
+import db
+
+# Отчеты больше этого размера уходят из памяти во временный файл на диске
+EXPORT_SPOOL_MAX_BYTES = int(os.getenv("EXPORT_SPOOL_MAX_MB", 8)) * 1024 * 1024
+
+async def export_trips_xlsx(user_id: int, group_by: str = None, name: str = None, date_from=None, date_to=None):
+    """
+    Пишет поездки пользователя (за период [date_from, date_to), если задан) в xlsx
+    в режиме constant_memory, строка за строкой из курсора.
+    Ширина колонок считается по значениям, встреченным во время записи.
+    Возвращает (файловый объект, перемотанный в начало, число строк). Файл нужно закрыть после отправки.
+    """
+    output = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX_BYTES)
+    workbook = xlsxwriter.Workbook(output, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Отчет')
+    header_format = workbook.add_format({'bold': True, 'border': 1})
+    date_format = workbook.add_format({'num_format': 'dd.mm.yy'})
+
+    columns = db.TRIPS_COLUMNS
+    date_idx = columns.index('Дата')
+    worksheet.write_row(0, 0, columns, header_format)
+    widths = [len(column) + 1 for column in columns]
+    widths[date_idx] = max(widths[date_idx], len('dd.mm.yy'))
+    row_count = 0
+    async for record in db.iter_trips(user_id, group_by, name, date_from, date_to):
+        row_count += 1
+        values = [record[column] for column in columns]
+        # Дата приходит из БД как date и пишется отдельно с форматом, иначе Excel покажет число
+        trip_date, values[date_idx] = values[date_idx], None
+        worksheet.write_row(row_count, 0, values)
+        if trip_date is not None:
+            worksheet.write_datetime(row_count, date_idx, trip_date, date_format)
+        for idx, value in enumerate(values):
+            if value is not None:
+                widths[idx] = max(widths[idx], len(str(value)))
+
+    # В режиме constant_memory ширину колонок можно задать и после записи строк
+    for idx, width in enumerate(widths):
+        worksheet.set_column(idx, idx, width)
+    workbook.close()
+    output.seek(0)
+    return output, row_count
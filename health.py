@@ -0,0 +1,119 @@
+# health.py - health/readiness и /metrics на event loop'е бота, отказ от тяжелой работы под нагрузкой
+
+import os
+import json
+import time
+import asyncio
+import logging
+from collections import deque
+import db
+import ingest
+import metrics
+
+# Порт у каждой реплики свой (HEALTH_PORT), чтобы проба и Prometheus попадали в конкретный процесс
+HEALTH_PORT = int(os.getenv("HEALTH_PORT", os.getenv("PORT", 8080)))
+LAG_INTERVAL = float(os.getenv("LOOP_LAG_INTERVAL", 0.5))
+LAG_WINDOW = float(os.getenv("LOOP_LAG_WINDOW", 10))  # задержка считается как максимум за это окно
+REQUEST_TIMEOUT = 5
+# Пороги готовности: выше любого из них реплика отвечает "not ready" и не берет экспорты и загрузки
+READY_MAX_LOOP_LAG = float(os.getenv("READY_MAX_LOOP_LAG", 1.0))
+READY_MAX_POOL_WAITERS = int(os.getenv("READY_MAX_POOL_WAITERS", 5))
+READY_MAX_PARSE_QUEUE = int(os.getenv("READY_MAX_PARSE_QUEUE", max(1, ingest.PARSE_QUEUE_SIZE * 3 // 4)))
+READY_MAX_BACKLOG_AGE = float(os.getenv("READY_MAX_BACKLOG_AGE", 30))
+
+server = None
+lag_task = None
+lag_samples = deque(maxlen=max(1, int(LAG_WINDOW / LAG_INTERVAL)))  # на сколько опаздывали пробуждения контрольной задачи
+
+async def _measure_loop_lag():
+    while True:
+        started = time.monotonic()
+        await asyncio.sleep(LAG_INTERVAL)
+        lag_samples.append(max(0.0, time.monotonic() - started - LAG_INTERVAL))
+
+def loop_lag() -> float:
+    return max(lag_samples, default=0.0)
+
+def status() -> dict:
+    """Текущая нагрузка: пул соединений, задержка event loop'а и очередь разбора."""
+    pool = db.pool
+    size = pool.get_size() if pool else 0
+    return {
+        'pool_size': size,
+        'pool_max_size': pool.get_max_size() if pool else 0,
+        'pool_in_use': size - pool.get_idle_size() if pool else 0,
+        'pool_waiters': db.pool_waiters,
+        'loop_lag': round(loop_lag(), 3),
+        'parse_queue': ingest.queue_depth(),
+        'parse_backlog_age': round(ingest.backlog_age(), 1),
+    }
+
+def overloaded(current: dict = None) -> list:
+    """Список причин, по которым реплика сейчас не готова брать работу (пустой - готова)."""
+    current = current or status()
+    reasons = []
+    if db.pool is None: reasons.append('database unavailable')
+    if current['pool_waiters'] > READY_MAX_POOL_WAITERS: reasons.append('pool_waiters')
+    if current['loop_lag'] > READY_MAX_LOOP_LAG: reasons.append('loop_lag')
+    if current['parse_queue'] > READY_MAX_PARSE_QUEUE: reasons.append('parse_queue')
+    if current['parse_backlog_age'] > READY_MAX_BACKLOG_AGE: reasons.append('parse_backlog_age')
+    return reasons
+
+async def _write_response(writer, status_line: str, content_type: str, body: bytes, head: bool):
+    writer.write((f"HTTP/1.1 {status_line}\r\nContent-Type: {content_type}\r\n"
+                  f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n").encode())
+    if not head: writer.write(body)
+    await writer.drain()
+
+async def _handle_request(reader, writer):
+    try:
+        request_line = await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)
+        # Заголовки не нужны, но их надо дочитать до пустой строки
+        while (await asyncio.wait_for(reader.readline(), REQUEST_TIMEOUT)).strip(): pass
+        parts = request_line.decode('latin-1').split()
+        method, path = (parts[0], parts[1].split('?')[0]) if len(parts) >= 2 else ('GET', '/')
+        head = method == 'HEAD'
+        if path == '/metrics':
+            await _write_response(writer, "200 OK", "text/plain; version=0.0.4; charset=utf-8", metrics.render().encode(), head)
+        elif path == '/ready':
+            current = status()
+            reasons = overloaded(current)
+            body = json.dumps({'ready': not reasons, 'reasons': reasons, **current}).encode()
+            await _write_response(writer, "503 Service Unavailable" if reasons else "200 OK", "application/json", body, head)
+        else:
+            await _write_response(writer, "200 OK", "text/plain", b"Bot is alive", head)
+    except (asyncio.TimeoutError, ConnectionError):
+        pass
+    except Exception as e:
+        logging.error(f"Health check request failed: {e}")
+    finally:
+        writer.close()
+
+async def start_server(port: int = HEALTH_PORT):
+    """Запускает HTTP-сервер (/, /ready, /metrics) и замер задержки на текущем event loop'е."""
+    global server, lag_task
+    if server is not None: return
+    lag_task = asyncio.create_task(_measure_loop_lag())
+    server = await asyncio.start_server(_handle_request, port=port)
+    logging.info(f"Health check server listening on port {port}.")
+
+async def stop_server():
+    global server, lag_task
+    if lag_task is not None:
+        lag_task.cancel()
+        await asyncio.gather(lag_task, return_exceptions=True)
+        lag_task = None
+    lag_samples.clear()
+    if server is not None:
+        server.close()
+        await server.wait_closed()
+        server = None
+
+def _health_metrics() -> list:
+    current = status()
+    return ["# TYPE bot_db_pool_size gauge", f"bot_db_pool_size {current['pool_size']}",
+            "# TYPE bot_db_pool_in_use gauge", f"bot_db_pool_in_use {current['pool_in_use']}",
+            "# TYPE bot_db_pool_waiters gauge", f"bot_db_pool_waiters {current['pool_waiters']}",
+            "# TYPE bot_event_loop_lag_seconds gauge", f"bot_event_loop_lag_seconds {current['loop_lag']}",
+            "# TYPE bot_ready gauge", f"bot_ready {0 if overloaded(current) else 1}"]
+metrics.collectors.append(_health_metrics)
@@ -0,0 +1,191 @@
+# ingest.py - разбор загруженных файлов вне event loop'а бота
+
+import os
+import io
+import time
+import asyncio
+import logging
+import zipfile
+from collections import defaultdict
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from parser import process_excel_file
+import metrics
+
+PARSE_WORKERS = int(os.getenv("PARSE_WORKERS", 2))
+PARSE_QUEUE_SIZE = int(os.getenv("PARSE_QUEUE_SIZE", 20))
+PARSE_PER_USER_LIMIT = int(os.getenv("PARSE_PER_USER_LIMIT", 2))
+PARSE_TIMEOUT = float(os.getenv("PARSE_TIMEOUT", 60))
+ARCHIVE_MAX_FILES = int(os.getenv("ARCHIVE_MAX_FILES", 50))
+ARCHIVE_MAX_BYTES = int(os.getenv("ARCHIVE_MAX_BYTES", 200 * 1024 * 1024))
+EXCEL_EXTENSIONS = ('.xlsx', '.xlsm')
+
+executor = None
+queue = None
+workers = []
+active_per_user = defaultdict(int)
+stats = {'parsing': 0}  # файлов сейчас в разборе
+enqueued_at = {}  # future файла в очереди -> время постановки (для возраста очереди)
+
+class ParseQueueFull(Exception):
+    """Общая очередь разбора заполнена."""
+
+class ParseUserLimit(Exception):
+    """У пользователя уже максимум файлов в обработке."""
+
+class ArchiveError(Exception):
+    """Архив поврежден или слишком велик."""
+
+def is_archive(file_name: str) -> bool:
+    return (file_name or '').lower().endswith('.zip')
+
+def expand_archive(file_content: bytes) -> list:
+    """
+    Распаковывает ZIP-архив в список (имя файла, содержимое) для Excel-файлов внутри.
+    Служебные файлы и папки пропускаются. Бросает ArchiveError, если архив поврежден
+    или в нем больше ARCHIVE_MAX_FILES файлов / ARCHIVE_MAX_BYTES распакованных байт.
+    """
+    try:
+        with zipfile.ZipFile(io.BytesIO(file_content)) as archive:
+            members = [m for m in archive.infolist()
+                       if not m.is_dir() and m.filename.lower().endswith(EXCEL_EXTENSIONS)
+                       and not m.filename.startswith('__MACOSX/') and not os.path.basename(m.filename).startswith(('.', '~$'))]
+            if len(members) > ARCHIVE_MAX_FILES:
+                raise ArchiveError(f"в архиве больше {ARCHIVE_MAX_FILES} файлов")
+            # Размер из заголовков проверяем до распаковки, чтобы не раздуть память
+            if sum(m.file_size for m in members) > ARCHIVE_MAX_BYTES:
+                raise ArchiveError(f"архив больше {ARCHIVE_MAX_BYTES // (1024 * 1024)} МБ в распакованном виде")
+            return [(os.path.basename(m.filename), archive.read(m)) for m in members]
+    except (zipfile.BadZipFile, zipfile.LargeZipFile, NotImplementedError, RuntimeError) as e:
+        raise ArchiveError(f"архив не удалось прочитать ({e})")
+
+async def _worker():
+    loop = asyncio.get_running_loop()
+    while True:
+        file_content, file_name, on_started, future = await queue.get()
+        enqueued_at.pop(future, None)
+        try:
+            if future.cancelled():
+                continue
+            if on_started:
+                try: await on_started()
+                except Exception as e: logging.warning(f"Parse status callback failed: {e}")
+            pool = executor
+            stats['parsing'] += 1
+            try:
+                # Сломанный пул бросает BrokenProcessPool прямо при постановке задачи, поэтому она внутри try
+                job = loop.run_in_executor(pool, process_excel_file, file_content, file_name)
+                result = await asyncio.wait_for(job, timeout=PARSE_TIMEOUT)
+            except asyncio.TimeoutError as e:
+                logging.warning(f"Parsing of '{file_name}' timed out after {PARSE_TIMEOUT}s.")
+                _recycle_executor(pool)
+                if not future.done(): future.set_exception(e)
+                continue
+            except BrokenProcessPool as e:
+                # Процесс разбора умер (например, убит по памяти): без замены пула падали бы все следующие файлы
+                logging.error(f"Parse process died while parsing '{file_name}', restarting the pool.")
+                _recycle_executor(pool)
+                if not future.done(): future.set_exception(e)
+                continue
+            except Exception as e:
+                if not future.done(): future.set_exception(e)
+                continue
+            finally:
+                stats['parsing'] -= 1
+            if not future.done(): future.set_result(result)
+        finally:
+            queue.task_done()
+
+def _recycle_executor(old):
+    """
+    Заменяет пул процессов old новым. wait_for только перестает ждать разбор, сам процесс остается занят,
+    и следующие файлы ждали бы его, расходуя свой таймаут; сломанный пул не принимает задачи вовсе.
+    Старый пул завершится, когда его процессы доделают начатое. Если old уже заменен
+    (другой воркер успел раньше), ничего не делает.
+    """
+    global executor
+    if old is not executor or executor is None: return
+    executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    old.shutdown(wait=False)
+
+def start_workers():
+    """Запускает пул процессов и задачи-воркеры на текущем event loop'е."""
+    global executor, queue
+    if executor is not None: return
+    executor = ProcessPoolExecutor(max_workers=PARSE_WORKERS)
+    queue = asyncio.Queue(maxsize=PARSE_QUEUE_SIZE)
+    workers.extend(asyncio.create_task(_worker()) for _ in range(PARSE_WORKERS))
+    logging.info(f"Parse pool started: {PARSE_WORKERS} workers, queue size {PARSE_QUEUE_SIZE}.")
+
+async def stop_workers():
+    """Останавливает воркеры и пул процессов."""
+    global executor, queue
+    for task in workers: task.cancel()
+    await asyncio.gather(*workers, return_exceptions=True)
+    workers.clear()
+    enqueued_at.clear()
+    if executor is not None:
+        executor.shutdown(wait=False, cancel_futures=True)
+    executor = None
+    queue = None
+
+def queue_depth() -> int:
+    """Количество файлов, ожидающих разбора."""
+    return queue.qsize() if queue is not None else 0
+
+def backlog_age() -> float:
+    """Сколько секунд ждет разбора самый старый файл в очереди (0, если очередь пуста)."""
+    return time.monotonic() - min(enqueued_at.values()) if enqueued_at else 0.0
+
+def _queue_metrics() -> list:
+    return ["# TYPE bot_parse_queue_depth gauge", f"bot_parse_queue_depth {queue_depth()}",
+            "# TYPE bot_parse_in_progress gauge", f"bot_parse_in_progress {stats['parsing']}",
+            "# TYPE bot_parse_backlog_age_seconds gauge", f"bot_parse_backlog_age_seconds {backlog_age()}"]
+metrics.collectors.append(_queue_metrics)
+
+def _reserve(user_id: int):
+    """Занимает место пользователя (одна загрузка - пачка файлов). Бросает ParseUserLimit."""
+    if active_per_user[user_id] >= PARSE_PER_USER_LIMIT:
+        raise ParseUserLimit()
+    active_per_user[user_id] += 1
+
+def _release(user_id: int):
+    active_per_user[user_id] -= 1
+    if active_per_user[user_id] <= 0:
+        del active_per_user[user_id]
+
+async def _parse_queued(file_content: bytes, file_name: str, on_started=None):
+    if executor is None:
+        start_workers()
+    future = asyncio.get_running_loop().create_future()
+    try:
+        queue.put_nowait((file_content, file_name, on_started, future))
+    except asyncio.QueueFull:
+        raise ParseQueueFull()
+    enqueued_at[future] = time.monotonic()
+    try:
+        return await future
+    finally:
+        future.cancel()
+        enqueued_at.pop(future, None)
+
+async def parse_batch(user_id: int, files: list, on_started=None) -> list:
+    """
+    Разбирает несколько файлов параллельно (не больше PARSE_PER_USER_LIMIT одновременно).
+    Пачка занимает одно место пользователя на все файлы, как одна загрузка.
+    files - список (имя файла, содержимое). Возвращает результаты в том же порядке: DataFrame, None
+    или исключение (ParseUserLimit, ParseQueueFull, asyncio.TimeoutError, ...) для файла, который разобрать не удалось.
+    """
+    if not files: return []
+    try:
+        _reserve(user_id)
+    except ParseUserLimit as e:
+        return [e] * len(files)
+    slots = asyncio.Semaphore(PARSE_PER_USER_LIMIT)
+    async def parse_one(file_name, file_content):
+        async with slots:
+            return await _parse_queued(file_content, file_name, on_started)
+    try:
+        return await asyncio.gather(*(parse_one(name, content) for name, content in files), return_exceptions=True)
+    finally:
+        _release(user_id)
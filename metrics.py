@@ -0,0 +1,195 @@
+# metrics.py - задержки обработчиков, фазы и вызовы БД в формате Prometheus
+
+import os
+import sys
+import time
+import logging
+import threading
+import functools
+import traceback
+import contextvars
+from collections import Counter, defaultdict
+from contextlib import contextmanager
+from telegram.request import HTTPXRequest
+
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+# Профилировщик медленных обновлений: порог в секундах (0 - выключен) и период выборки стеков
+SLOW_UPDATE_THRESHOLD = float(os.getenv("SLOW_UPDATE_THRESHOLD", 0))
+PROFILE_INTERVAL = float(os.getenv("PROFILE_INTERVAL_MS", 10)) / 1000
+
+# Профилировщик и потоки to_thread/executor'ов могут писать метрики параллельно с loop'ом, поэтому все изменения - под замком
+lock = threading.Lock()
+
+class Histogram:
+    def __init__(self, name: str, help_text: str, labels: tuple, buckets: tuple = LATENCY_BUCKETS):
+        self.name, self.help_text, self.labels, self.buckets = name, help_text, labels, buckets
+        self.series = {}  # значения меток -> [счетчики по корзинам, сумма, количество]
+
+    def observe(self, value: float, *label_values):
+        with lock:
+            series = self.series.setdefault(label_values, [[0] * len(self.buckets), 0.0, 0])
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    series[0][i] += 1
+            series[1] += value
+            series[2] += 1
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} histogram"]
+        for label_values, (bucket_counts, total, count) in self.series.items():
+            labels = _labels(self.labels, label_values)
+            for bound, bucket_count in zip(self.buckets, bucket_counts):
+                lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + (bound,))} {bucket_count}")
+            lines.append(f"{self.name}_bucket{_labels(self.labels + ('le',), label_values + ('+Inf',))} {count}")
+            lines.append(f"{self.name}_sum{labels} {total}")
+            lines.append(f"{self.name}_count{labels} {count}")
+        return lines
+
+class CounterMetric:
+    def __init__(self, name: str, help_text: str, labels: tuple):
+        self.name, self.help_text, self.labels = name, help_text, labels
+        self.series = defaultdict(float)
+
+    def inc(self, value: float = 1, *label_values):
+        with lock:
+            self.series[label_values] += value
+
+    def render(self) -> list:
+        lines = [f"# HELP {self.name} {self.help_text}", f"# TYPE {self.name} counter"]
+        for label_values, value in self.series.items():
+            lines.append(f"{self.name}{_labels(self.labels, label_values)} {value}")
+        return lines
+
+def _labels(names: tuple, values: tuple) -> str:
+    if not names: return ""
+    escaped = (str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n") for v in values)
+    return "{" + ",".join(f'{k}="{v}"' for k, v in zip(names, escaped)) + "}"
+
+handler_latency = Histogram("bot_handler_seconds", "Время обработки обновления", ("handler", "callback_data"))
+phase_latency = Histogram("bot_phase_seconds", "Время фаз обработки", ("phase",))
+db_latency = Histogram("bot_db_call_seconds", "Время вызовов db.py", ("function",))
+pool_acquire_wait = Histogram("bot_db_pool_acquire_seconds", "Ожидание соединения из пула", ())
+telegram_latency = Histogram("bot_telegram_api_seconds", "Время запросов к Telegram Bot API", ("method",))
+rows_fetched = CounterMetric("bot_db_rows_fetched_total", "Строк получено из БД", ("function",))
+handler_errors = CounterMetric("bot_handler_errors_total", "Необработанные исключения в обработчиках", ("handler",))
+
+# Сюда другие модули добавляют функции, отдающие строки для /metrics (например, размеры кэшей)
+collectors = []
+
+def render() -> str:
+    """Текст для /metrics в формате Prometheus."""
+    lines = []
+    with lock:
+        for metric in (handler_latency, phase_latency, db_latency, pool_acquire_wait, telegram_latency, rows_fetched, handler_errors):
+            lines.extend(metric.render())
+    for collector in collectors:
+        try: lines.extend(collector())
+        except Exception as e: logging.error(f"Metrics collector failed: {e}")
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def phase(name: str):
+    """Замеряет фазу обработки: with metrics.phase('parse'): ..."""
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        phase_latency.observe(time.perf_counter() - started, name)
+
+# Вложенные вызовы db.py (search_items -> get_item_names и т.п.) не должны считать фазу 'db' дважды
+in_db_call = contextvars.ContextVar('in_db_call', default=False)
+
+def timed_db(func):
+    """Декоратор для корутин db.py: время вызова по имени функции, плюс фаза 'db' (только для внешнего вызова)."""
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        outer = not in_db_call.get()
+        token = in_db_call.set(True) if outer else None
+        started = time.perf_counter()
+        try:
+            return await func(*args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            db_latency.observe(elapsed, func.__name__)
+            if outer:
+                in_db_call.reset(token)
+                phase_latency.observe(elapsed, "db")
+    return wrapper
+
+def timed_handler(func):
+    """Декоратор для обработчиков бота: гистограмма по имени обработчика и callback_data."""
+    @functools.wraps(func)
+    async def wrapper(update, context, *args, **kwargs):
+        query = getattr(update, "callback_query", None)
+        callback_data = query.data if query and query.data else ""
+        token = profiler.begin() if profiler else None
+        started = time.perf_counter()
+        try:
+            return await func(update, context, *args, **kwargs)
+        except Exception:
+            handler_errors.inc(1, func.__name__)
+            raise
+        finally:
+            elapsed = time.perf_counter() - started
+            handler_latency.observe(elapsed, func.__name__, callback_data)
+            if token is not None:
+                profiler.end(token, elapsed, f"{func.__name__} {callback_data}".strip())
+    return wrapper
+
+class TimedRequest(HTTPXRequest):
+    """HTTPXRequest, который замеряет каждый запрос к Bot API (скачивание файлов - фаза 'download')."""
+    async def do_request(self, url, method, *args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await super().do_request(url, method, *args, **kwargs)
+        finally:
+            elapsed = time.perf_counter() - started
+            if "/file/bot" in url:
+                phase_latency.observe(elapsed, "download")
+            else:
+                api_method = url.rsplit("/", 1)[-1]
+                telegram_latency.observe(elapsed, api_method)
+                phase_latency.observe(elapsed, "telegram_send")
+
+class SlowUpdateProfiler:
+    """
+    Сэмплирующий профилировщик: пока есть обновления в работе, фоновый поток снимает стек
+    потока event loop'а. Если обновление обрабатывалось дольше порога, в лог уходят самые частые стеки.
+    """
+    def __init__(self, threshold: float, interval: float):
+        self.threshold, self.interval = threshold, interval
+        self.target_thread_id = None
+        self.active = {}  # токен -> Counter стеков
+        self.next_token = 0
+        self.wakeup = threading.Event()
+        threading.Thread(target=self._run, name="slow-update-profiler", daemon=True).start()
+
+    def begin(self) -> int:
+        with lock:
+            self.target_thread_id = threading.get_ident()
+            self.next_token += 1
+            self.active[self.next_token] = Counter()
+            self.wakeup.set()
+            return self.next_token
+
+    def end(self, token: int, elapsed: float, label: str):
+        with lock:
+            samples = self.active.pop(token, None)
+            if not self.active:
+                self.wakeup.clear()
+        if samples and elapsed >= self.threshold:
+            top = "\n".join(f"--- {count} samples ---\n{stack}" for stack, count in samples.most_common(5))
+            logging.warning(f"Slow update '{label}': {elapsed:.2f}s, {sum(samples.values())} samples\n{top}")
+
+    def _run(self):
+        while True:
+            self.wakeup.wait()
+            time.sleep(self.interval)
+            frame = sys._current_frames().get(self.target_thread_id)
+            if frame is None: continue
+            stack = "".join(traceback.format_stack(frame, limit=15))
+            with lock:
+                for samples in self.active.values():
+                    samples[stack] += 1
+
+profiler = SlowUpdateProfiler(SLOW_UPDATE_THRESHOLD, PROFILE_INTERVAL) if SLOW_UPDATE_THRESHOLD > 0 else None
@@ -0,0 +1,101 @@
+# outbound.py - исходящие запросы к Bot API: ограничение частоты и повтор после flood control
+
+import os
+import time
+import asyncio
+import logging
+from datetime import timedelta
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+import metrics
+
+# Лимиты Telegram: ~30 сообщений в секунду на бота, ~1 в секунду в личный чат, ~20 в минуту в группу
+GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", 30))
+CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", 1))
+GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE_PER_MIN", 20)) / 60
+CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", 3))
+MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", 3))
+MAX_CHAT_BUCKETS = 10000
+
+stats = {'retry_after': 0, 'throttled_seconds': 0.0}
+
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()  # ожидающие получают токены по очереди, порядок сообщений сохраняется
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    @property
+    def full(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+    async def acquire(self):
+        """Ждет свободный токен и забирает его."""
+        async with self.lock:
+            self._refill()
+            if self.tokens < 1:
+                delay = (1 - self.tokens) / self.rate
+                stats['throttled_seconds'] += delay
+                await asyncio.sleep(delay)
+                self._refill()
+            self.tokens -= 1
+
+class RateLimiter(BaseRateLimiter):
+    """
+    Пропускает запросы, отправляющие что-то в чат (есть chat_id), через общий token bucket бота
+    и bucket конкретного чата. Остальные запросы (answerCallbackQuery, getFile, ...) идут без задержки.
+    На RetryAfter все отправки приостанавливаются на указанное Telegram время, запрос повторяется
+    до MAX_RETRIES раз.
+    """
+    def __init__(self, max_retries: int = MAX_RETRIES):
+        self.max_retries = max_retries
+        self.global_bucket = TokenBucket(GLOBAL_RATE, GLOBAL_RATE)
+        self.chat_buckets = {}
+        self.paused_until = 0.0
+
+    async def initialize(self): pass
+
+    async def shutdown(self):
+        self.chat_buckets.clear()
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self.chat_buckets) >= MAX_CHAT_BUCKETS:
+                # Полные buckets ничем не отличаются от новых - их можно выбросить
+                for key in [k for k, b in self.chat_buckets.items() if b.full]:
+                    del self.chat_buckets[key]
+            is_group = isinstance(chat_id, int) and chat_id < 0
+            bucket = self.chat_buckets[chat_id] = TokenBucket(GROUP_RATE if is_group else CHAT_RATE, CHAT_BURST)
+        return bucket
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get('chat_id')
+        for attempt in range(self.max_retries + 1):
+            pause = self.paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            if chat_id is not None:
+                await self._chat_bucket(chat_id).acquire()
+                await self.global_bucket.acquire()
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt >= self.max_retries:
+                    raise
+                stats['retry_after'] += 1
+                delay = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                logging.warning(f"Flood control on {endpoint} (chat {chat_id}), retrying in {delay}s.")
+                self.paused_until = max(self.paused_until, time.monotonic() + delay + 0.1)
+
+def _limiter_metrics() -> list:
+    return ["# TYPE bot_telegram_retry_after_total counter", f"bot_telegram_retry_after_total {stats['retry_after']}",
+            "# TYPE bot_telegram_throttled_seconds_total counter", f"bot_telegram_throttled_seconds_total {stats['throttled_seconds']}"]
+metrics.collectors.append(_limiter_metrics)
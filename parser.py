@@ -3,96 +3,153 @@ import openpyxl
 import re
 import io # Добавляем io для работы с файлами в памяти
 
-def find_table_structure(ws):
-    """Находит структуру таблицы по ключевым заголовкам"""
+def find_table_structure(rows):
+    """
+    Находит структуру таблицы по ключевым заголовкам.
+    Читает строки из итератора (кортежи значений) только до тех пор, пока не найдены
+    обе колонки, поэтому оставшиеся строки итератора — это уже строки с данными.
+    Возвращает {'description': (номер_строки, индекс_колонки), 'amount': (...)}.
+    """
     headers_positions = {}
-    for row in ws.iter_rows():
-        for cell in row:
-            if cell.value:
-                cell_value = str(cell.value).strip()
+    for row_idx, row in enumerate(rows, 1):
+        for col_idx, value in enumerate(row):
+            if value:
+                cell_value = str(value).strip()
                 if "Товары (работы, услуги)" in cell_value:
-                    headers_positions['description'] = (cell.row, cell.column)
+                    headers_positions['description'] = (row_idx, col_idx)
                 elif "Сумма" in cell_value and "Сумма с НДС" not in cell_value:
-                    headers_positions['amount'] = (cell.row, cell.column)
+                    headers_positions['amount'] = (row_idx, col_idx)
+        if 'description' in headers_positions and 'amount' in headers_positions:
+            break
     return headers_positions
 
+# Шаблоны извлечения данных из описания, общие для построчного и колоночного разбора
+DATE_PATTERN = re.compile(r'от\s+(\d{2}\.\d{2}\.\d{2})')
+PLATE_PATTERN = re.compile(r'(\d{3})')
+DRIVER_PATTERN = re.compile(r',\s*([А-ЯЁ][а-яё]+)\s+[А-ЯЁ]\.[А-ЯЁ]\.')
+ALT_DRIVER_PATTERN = re.compile(r',\s*([А-ЯЁ][а-яё]+)')
+SKIP_WORDS = ('итого', 'всего', 'сумма')
+
+# Сколько сырых строк накапливать перед колоночной обработкой
+PARSE_CHUNK_ROWS = 10000
+
 def extract_data_from_description(description):
     """Извлекает дату, маршрут, гос. номер и фамилию водителя из описания"""
     description_str = str(description)
     
     route = description_str.split(',')[0].strip()
     
-    date_match = re.search(r'от\s+(\d{2}\.\d{2}\.\d{2})', description_str)
+    date_match = DATE_PATTERN.search(description_str)
     date_str = date_match.group(1) if date_match else "Дата не найдена"
     
-    plate_match = re.search(r'(\d{3})', description_str)
+    plate_match = PLATE_PATTERN.search(description_str)
     car_plate = plate_match.group(1) if plate_match else "Неизвестно"
     
-    driver_match = re.search(r',\s*([А-ЯЁ][а-яё]+)\s+[А-ЯЁ]\.[А-ЯЁ]\.', description_str)
+    driver_match = DRIVER_PATTERN.search(description_str)
     if driver_match:
         driver_name = driver_match.group(1)
     else:
-        alt_driver_match = re.search(r',\s*([А-ЯЁ][а-яё]+)', description_str)
+        alt_driver_match = ALT_DRIVER_PATTERN.search(description_str)
         driver_name = alt_driver_match.group(1) if alt_driver_match else "Фамилия не найдена"
     
     return route, date_str, car_plate, driver_name
 
-def process_excel_file(file_content: bytes, file_name: str):
+def _to_float(value):
+    try:
+        return float(value)
+    except (ValueError, TypeError):
+        return float('nan')
+
+def _first_group(pattern, strings, default=None):
+    search = pattern.search
+    return [m.group(1) if (m := search(s)) else default for s in strings]
+
+def extract_trips(descriptions: list, amounts: list, file_name: str) -> pd.DataFrame:
     """
-    Парсит один Excel-файл из байтового потока и возвращает DataFrame.
+    Колоночный аналог extract_data_from_description для пачки строк счета.
+    Отбрасывает итоговые строки и строки без номера/суммы, результат совпадает с построчным разбором.
+    """
+    # Сначала самые дешевые фильтры, чтобы регулярки гонялись только по оставшимся строкам.
+    # Каждая скомпилированная регулярка проходит по колонке целиком: методы .str в pandas
+    # здесь не помогают — они тоже вызывают Python-функцию на каждый элемент, только медленнее.
+    amount_values = [_to_float(str(amount).replace(' ', '').replace(',', '.')) for amount in amounts]
+    rows = [(str(d), v) for d, v in zip(descriptions, amount_values) if v > 0]
+    rows = [(d, v) for d, v in rows if not any(word in d.lower() for word in SKIP_WORDS)]
+    plates = _first_group(PLATE_PATTERN, [d for d, _ in rows])
+    rows = [(d, v, p) for (d, v), p in zip(rows, plates) if p is not None]
+
+    descriptions = [d for d, _, _ in rows]
+    drivers = _first_group(DRIVER_PATTERN, descriptions)
+    drivers = [name if name is not None else (m.group(1) if (m := ALT_DRIVER_PATTERN.search(d)) else "Фамилия не найдена")
+               for name, d in zip(drivers, descriptions)]
+
+    return pd.DataFrame({
+        'Дата': _first_group(DATE_PATTERN, descriptions, "Дата не найдена"),
+        'Маршрут': [d.partition(',')[0].strip() for d in descriptions],
+        'Стоимость': pd.Series([v for _, v, _ in rows], dtype='float64'),
+        'Гос_номер': [p for _, _, p in rows],
+        'Водитель': drivers,
+        'Источник': file_name,
+    })
+
+def iter_excel_chunks(file_content: bytes, file_name: str, chunk_rows: int = PARSE_CHUNK_ROWS):
+    """
+    Потоково читает Excel-файл и отдает распознанные строки пачками (DataFrame).
+    Книга открывается в режиме read_only, поэтому память не растёт с размером файла.
     """
+    # Используем io.BytesIO для чтения файла из памяти
+    wb = openpyxl.load_workbook(io.BytesIO(file_content), read_only=True, data_only=True)
     try:
-        # Используем io.BytesIO для чтения файла из памяти
-        wb = openpyxl.load_workbook(io.BytesIO(file_content), data_only=True)
         ws = wb.active
-        
-        headers = find_table_structure(ws)
-        
+        rows = ws.iter_rows(values_only=True)
+
+        headers = find_table_structure(rows)
+
         if not headers.get('description') or not headers.get('amount'):
             print(f"⚠️ В файле {file_name} не найдена структура таблицы.")
-            return None
-        
-        header_row = max(h[0] for h in headers.values())
+            return
+
         description_col = headers['description'][1]
         amount_col = headers['amount'][1]
-        
-        parsed_data = []
-        row_num = header_row + 1
-        
-        # Проходимся по строкам до определенного предела или пока есть данные
-        for row_num in range(header_row + 1, ws.max_row + 1):
-            description = ws.cell(row=row_num, column=description_col).value
-            amount = ws.cell(row=row_num, column=amount_col).value
+        max_col = max(description_col, amount_col)
 
+        descriptions, amounts = [], []
+        # Итератор уже стоит на строке после заголовков
+        for row in rows:
+            if len(row) <= max_col:
+                continue
+            description = row[description_col]
+            amount = row[amount_col]
             if not description or not amount:
                 continue
+            descriptions.append(description)
+            amounts.append(amount)
+            if len(descriptions) >= chunk_rows:
+                chunk = extract_trips(descriptions, amounts, file_name)
+                if not chunk.empty: yield chunk
+                descriptions, amounts = [], []
+        if descriptions:
+            chunk = extract_trips(descriptions, amounts, file_name)
+            if not chunk.empty: yield chunk
+    finally:
+        wb.close()
 
-            description_str = str(description)
-            if any(word in description_str.lower() for word in ['итого', 'всего', 'сумма']):
-                continue
+def iter_excel_rows(file_content: bytes, file_name: str):
+    """Потоково парсит Excel-файл и по одной отдаёт распознанные строки (dict)."""
+    for chunk in iter_excel_chunks(file_content, file_name):
+        yield from chunk.to_dict('records')
 
-            try:
-                amount_str = str(amount).replace(' ', '').replace(',', '.')
-                amount_value = float(amount_str)
-
-                route, date_str, car_plate, driver_name = extract_data_from_description(description_str)
-                
-                if car_plate != "Неизвестно" and amount_value > 0:
-                    parsed_data.append({
-                        'Дата': date_str,
-                        'Маршрут': route,
-                        'Стоимость': amount_value,
-                        'Гос_номер': car_plate,
-                        'Водитель': driver_name,
-                        'Источник': file_name
-                    })
-            except (ValueError, TypeError):
-                continue
-        
-        if not parsed_data:
+def process_excel_file(file_content: bytes, file_name: str):
+    """
+    Парсит один Excel-файл из байтового потока и возвращает DataFrame.
+    """
+    try:
+        chunks = list(iter_excel_chunks(file_content, file_name))
+
+        if not chunks:
             return None
 
-        return pd.DataFrame(parsed_data)
+        return pd.concat(chunks, ignore_index=True)
 
     except Exception as e:
         print(f"❌ Ошибка при обработке файла {file_name}: {e}")
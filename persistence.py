@@ -0,0 +1,139 @@
+# persistence.py - состояние диалогов и user_data в Postgres, общее для всех реплик бота
+
+import os
+import logging
+from collections import OrderedDict
+from telegram import Update
+from telegram.ext import BasePersistence, PersistenceInput, ConversationHandler, TypeHandler, ContextTypes
+import db
+
+# Периодический сброс PTB нужен только как страховка: запись идет сразу после каждого обновления
+PERSISTENCE_INTERVAL = float(os.getenv("PERSISTENCE_INTERVAL", 60))
+# Сколько снимков user_data и состояний диалогов держать в памяти; забытые перечитываются из БД
+PERSISTENCE_CACHE_MAX = int(os.getenv("PERSISTENCE_CACHE_MAX", 10000))
+
+def _remember(cache: OrderedDict, key, value):
+    cache[key] = value
+    cache.move_to_end(key)
+    while len(cache) > PERSISTENCE_CACHE_MAX:
+        cache.popitem(last=False)
+
+class PostgresPersistence(BasePersistence):
+    """
+    Хранит user_data и состояния ConversationHandler'ов в Postgres, чтобы следующее обновление
+    пользователя могла обработать любая реплика.
+
+    Данные читаются лениво (по пользователю и ключу диалога) и перечитываются, только когда другая
+    реплика прислала STATE_CHANNEL-уведомление. Изменения пишутся сразу после обработки обновления
+    (см. register_handlers), и только если что-то действительно поменялось.
+    """
+    def __init__(self, update_interval: float = PERSISTENCE_INTERVAL):
+        super().__init__(store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+                         update_interval=update_interval)
+        self.user_data_snapshots = OrderedDict()  # user_id -> user_data в том виде, в каком он лежит в БД, порядок = LRU
+        self.conversation_states = OrderedDict()  # (имя диалога, ключ) -> состояние в БД (None - диалога нет), порядок = LRU
+        self.refresh_supported = True
+        db.subscribe(db.STATE_CHANNEL, self._on_state_changed)
+
+    def _on_state_changed(self, payload):
+        if payload is None:
+            self.user_data_snapshots.clear()
+            self.conversation_states.clear()
+        elif 'user_id' in payload:
+            self.user_data_snapshots.pop(payload['user_id'], None)
+        elif 'conversation' in payload:
+            self.conversation_states.pop((payload['conversation'], tuple(payload['key'])), None)
+
+    # user_data при старте не грузим: пользователи подтягиваются по мере обновлений
+    async def get_user_data(self): return {}
+    async def get_chat_data(self): return {}
+    async def get_bot_data(self): return {}
+    async def get_callback_data(self): return None
+
+    async def get_conversations(self, name):
+        # PTB вызывает это при initialize(), до post_init, поэтому пул поднимаем здесь (init_db идемпотентна)
+        if not await db.init_db(): return {}
+        conversations = await db.load_conversations(name)
+        for key, state in conversations.items():
+            _remember(self.conversation_states, (name, key), state)
+        return conversations
+
+    async def refresh_user_data(self, user_id, user_data):
+        if not db.pool: return
+        if user_id in self.user_data_snapshots:
+            self.user_data_snapshots.move_to_end(user_id)
+            return
+        data = await db.load_user_data(user_id)
+        user_data.clear()
+        user_data.update(data)
+        _remember(self.user_data_snapshots, user_id, data)
+
+    async def update_user_data(self, user_id, data):
+        # PTB отдает сюда копию user_data всех пользователей из обновления, даже если она не менялась
+        if self.user_data_snapshots.get(user_id) == data: return
+        await db.save_user_data(user_id, data)
+        _remember(self.user_data_snapshots, user_id, data)
+
+    async def drop_user_data(self, user_id):
+        await db.delete_user_data(user_id)
+        self.user_data_snapshots.pop(user_id, None)
+
+    async def update_conversation(self, name, key, new_state):
+        if (name, key) in self.conversation_states and self.conversation_states[(name, key)] == new_state: return
+        await db.save_conversation_state(name, key, new_state)
+        _remember(self.conversation_states, (name, key), new_state)
+
+    @staticmethod
+    def _can_refresh(handler: ConversationHandler) -> bool:
+        # Публичного API для подмены состояния диалога на лету у PTB нет (get_conversations читается
+        # один раз), поэтому используются внутренности PTB той версии, что закреплена в requirements.txt
+        return callable(getattr(handler, '_get_key', None)) and hasattr(getattr(handler, '_conversations', None), 'update_no_track')
+
+    async def refresh_conversation(self, handler: ConversationHandler, update: Update):
+        """Подтягивает из БД состояние диалога для этого обновления, если его могла поменять другая реплика."""
+        if not db.pool or not update.effective_chat or not update.effective_user: return
+        if not self._can_refresh(handler):
+            if self.refresh_supported:
+                self.refresh_supported = False
+                logging.warning("ConversationHandler internals changed: conversation state is loaded only at startup, "
+                                "updates from other replicas are not picked up.")
+            return
+        key = handler._get_key(update)
+        if (handler.name, key) in self.conversation_states:
+            self.conversation_states.move_to_end((handler.name, key))
+            return
+        state = await db.load_conversation_state(handler.name, key)
+        # Пишем мимо отслеживания изменений, иначе PTB тут же сохранил бы прочитанное обратно
+        if state is None:
+            handler._conversations.data.pop(key, None)
+        else:
+            handler._conversations.update_no_track({key: state})
+        _remember(self.conversation_states, (handler.name, key), state)
+
+    def register_handlers(self, application, first_group: int = -1, last_group: int = 1):
+        """
+        Добавляет обработчики, которые до всех остальных подтягивают состояние диалогов из БД,
+        а после них сразу записывают изменения (не дожидаясь периодического сброса PTB).
+        """
+        async def before_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            for handlers in application.handlers.values():
+                for handler in handlers:
+                    if isinstance(handler, ConversationHandler) and handler.persistent:
+                        await self.refresh_conversation(handler, update)
+
+        async def after_update(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            if update.effective_user:
+                application.mark_data_for_update_persistence(user_ids=update.effective_user.id)
+            await application.update_persistence()
+
+        application.add_handler(TypeHandler(Update, before_update), group=first_group)
+        application.add_handler(TypeHandler(Update, after_update), group=last_group)
+
+    # bot_data, chat_data и callback_data бот не использует
+    async def update_chat_data(self, chat_id, data): pass
+    async def update_bot_data(self, data): pass
+    async def update_callback_data(self, data): pass
+    async def drop_chat_data(self, chat_id): pass
+    async def refresh_chat_data(self, chat_id, chat_data): pass
+    async def refresh_bot_data(self, bot_data): pass
+    async def flush(self): pass
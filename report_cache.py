@@ -0,0 +1,65 @@
+# report_cache.py - повторная отправка уже сформированных отчетов по file_id Telegram
+
+import os
+import logging
+from collections import OrderedDict
+from telegram.error import BadRequest
+import db
+import metrics
+
+REPORT_CACHE_MAX_ENTRIES = int(os.getenv("REPORT_CACHE_MAX_ENTRIES", 2048))
+
+cache = OrderedDict()  # (user_id, тип отчета, фильтр) -> (версия данных, file_id, подпись), порядок = LRU
+stats = {'hits': 0, 'misses': 0}
+
+async def send_report(bot, chat_id: int, user_id: int, report_type: str, report_filter: tuple, build, filename: str) -> bool:
+    """
+    Отправляет отчет. Если такой же отчет (тип, фильтр) уже отправлялся при той же версии данных
+    пользователя, документ пересылается по file_id без генерации и загрузки.
+    build - корутина без аргументов, возвращающая (файловый объект с отчетом, подпись) или None, если отчет пуст;
+    файл закрывается после отправки. Возвращает False, если отправлять было нечего.
+    Новая загрузка или очистка данных поднимает версию, и старая запись перестает подходить.
+    """
+    key = (user_id, report_type, report_filter)
+    version = db.get_data_version(user_id)
+    entry = cache.get(key)
+    if entry and entry[0] == version:
+        try:
+            await bot.send_document(chat_id=chat_id, document=entry[1], caption=entry[2])
+            cache.move_to_end(key)
+            stats['hits'] += 1
+            return True
+        except BadRequest as e:
+            logging.warning(f"Cached report file_id rejected, regenerating: {e}")
+    cache.pop(key, None)
+    stats['misses'] += 1
+    report = await build()
+    if report is None:
+        return False
+    document, caption = report
+    try:
+        message = await bot.send_document(chat_id=chat_id, document=document, filename=filename, caption=caption)
+    finally:
+        document.close()
+    # Если данные изменились, пока отчет строился, он уже устарел
+    if message is not None and message.document and version == db.get_data_version(user_id):
+        cache[key] = (version, message.document.file_id, caption)
+        while len(cache) > REPORT_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+    return True
+
+def _on_trips_changed(payload):
+    # None - слушатель переподключился и мог пропустить уведомления: версия данных у пользователей,
+    # известных только этому кэшу, не поднялась бы, и устаревший file_id ушел бы как актуальный
+    if payload is None:
+        cache.clear()
+    else:
+        for key in [key for key in cache if key[0] == payload['user_id']]:
+            del cache[key]
+db.subscribe(db.TRIPS_CHANNEL, _on_trips_changed)
+
+def _report_cache_metrics() -> list:
+    return ["# TYPE bot_report_cache_hits_total counter", f"bot_report_cache_hits_total {stats['hits']}",
+            "# TYPE bot_report_cache_misses_total counter", f"bot_report_cache_misses_total {stats['misses']}",
+            "# TYPE bot_report_cache_entries gauge", f"bot_report_cache_entries {len(cache)}"]
+metrics.collectors.append(_report_cache_metrics)